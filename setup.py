@@ -21,6 +21,9 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'updipy = updipy.updipy:main',
+            'updipy-production = updipy.production:main',
+            'updipy-trace = updipy.trace:main',
+            'updipy-plan = updipy.plan:main',
         ],
     },
 )
@@ -1,8 +1,12 @@
+import io
+import contextlib
 import os
 import unittest
 import sys
 import os.path as path
 import random
+import tempfile
+import zlib
 
 
 class UpdipyTest(unittest.TestCase):
@@ -61,7 +65,7 @@ class UpdipyTest(unittest.TestCase):
 
     def test_write_flash(self):
         flash_size = self.updi.device.FLASH_PAGE_SIZE * self.updi.device.FLASH_PAGE_COUNT
-        memory = [random.randint(0, 0xff) for _ in range(flash_size)]
+        memory = bytes([random.randint(0, 0xff) for _ in range(flash_size)])
         self.updi.write_flash(memory)
 
         read = self.updi.read_flash()
@@ -92,17 +96,398 @@ class UpdipyTest(unittest.TestCase):
     def test_write_eeprom(self):
         flash_size = self.updi.device.EEPROM_PAGE_SIZE * \
             self.updi.device.EEPROM_PAGE_COUNT
-        memory = [random.randint(0, 0xff) for _ in range(flash_size)]
+        memory = bytes([random.randint(0, 0xff) for _ in range(flash_size)])
         self.updi.write_eeprom(memory)
 
         read = self.updi.read_eeprom()
         self.assertEqual(memory, read)
 
+    def test_read_userrow(self):
+        memory = self.updi.read_userrow()
+        self.assertEqual(self.updi.device.USERROW_SIZE, len(memory))
+
+
+class PlanTest(unittest.TestCase):
+    def test_plan_sample(self):
+        hex = IHex()
+        hex.read_file(path.dirname(__file__) + "/../sample.hex")
+        summary = plan(Device.select("ATtiny202"), hex).summary()
+        self.assertEqual(2, summary["flash"]["page_writes"])
+        self.assertEqual(1, summary["eeprom"]["page_writes"])
+        # protocol efficiency regression
+        self.assertLessEqual(summary["flash"]["frames"], 28)
+        self.assertLessEqual(summary["verify flash"]["frames"], 6)
+
+
+class LinkTest(unittest.TestCase):
+    def test_short_read(self):
+        class ShortLink(PlanLink):
+            # drop the second half of long responses as on a timeout
+            short = False
+
+            def read(self, size):
+                data = super().read(size)
+                return data[:size // 2] if self.short and size > 8 else data
+
+        device = Device.select("ATtiny202")
+        link = ShortLink(device)
+        updi = UPDI(None, device=device, transport=link)
+        target = UPDI_FUNC(None, device_name=device.DEVICE_NAME, updi=updi)
+        link.short = True
+        with self.assertRaises(LinkTimeoutError):
+            target.read_flash(size=64)
+
+    def test_burst_write(self):
+        device = Device.select("ATtiny202")
+        link = PlanLink(device)
+        updi = UPDI(None, device=device, transport=link)
+        target = UPDI_FUNC(None, device_name=device.DEVICE_NAME, updi=updi)
+        memory = bytes([random.randint(0, 0xff) for _ in range(0x80)])
+        self.assertEqual(2, target.write_flash(memory))
+        self.assertEqual(memory, target.read_flash(size=0x80))
+        self.assertFalse(link.rsd)
+
+
+class ProductionTest(unittest.TestCase):
+    def test_serial_number(self):
+        device = Device.select("ATtiny202")
+        link = PlanLink(device)
+        hex = IHex()
+        hex.read_file(path.dirname(__file__) + "/../sample.hex")
+        production = Production(None, hex, serial_addr=0x10, serial=5,
+                                serial_size=2, transport=link)
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = [production.program(), production.program()]
+        self.assertEqual(["OK", "OK"], [row["result"] for row in rows])
+        self.assertEqual([5, 6], [row["serial"] for row in rows])
+        start = device.EEPROM_START_ADDR
+        self.assertEqual(b"\x34\x12", link.mem[start:start + 2])
+        self.assertEqual(b"\x06\x00", link.mem[start + 0x10:start + 0x12])
+
+    def test_wait_removed(self):
+        production = Production(None, IHex(), interval=0,
+                                transport=PlanLink(Device.select("ATtiny202")))
+        probes = iter([False, True, False, False, False])
+        production.updi.probe = lambda: next(probes)
+        production.wait_target(False, 3)
+        self.assertEqual([], list(probes))
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = path.join(self.dir.name, "link.trace")
+
+        device = Device.select("ATtiny202")
+        trace = TraceWriter(self.file)
+        updi = UPDI(None, device=device, transport=PlanLink(device), trace=trace)
+        target = UPDI_FUNC(None, device_name=device.DEVICE_NAME, updi=updi)
+        target.write_flash(bytes(range(0x40)))
+        target.write_fuses([0x01])
+        trace.close()
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_summarize(self):
+        speed, records = read_trace(self.file)
+        self.assertEqual(115200, speed)
+        summary = summarize(records)
+        self.assertEqual(len(records), summary["frames"])
+        self.assertEqual(0, summary["timeouts"])
+        # ST PTR, REPEAT and the ST burst, not the following STS and LDS
+        self.assertEqual(3, summary["pointers"][0x8000][0])
+        self.assertEqual(3, summary["pointers"][0x1006][0])
+
+    def test_replay(self):
+        _, records = read_trace(self.file)
+        elapsed, delay = replay(records, realtime=False)
+        self.assertLess(0, elapsed)
+        self.assertEqual(0, delay)
+
+
+class ApiTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.device = Device.select("ATtiny202")
+        self.link = PlanLink(self.device)
+        self.programmer = Programmer(None, transport=self.link)
+
+    def test_pages_of(self):
+        memory = [None] * 0x10000
+        memory[0x41] = 0x12
+        data, crcs = pages_of(memory, 0x40, 4)
+        self.assertEqual(0x100, len(data))
+        self.assertEqual([1], list(crcs))
+        self.assertEqual(zlib.crc32(data[0x40:0x80]), crcs[1])
+
+        data, crcs = pages_of(b"\x00" * 0x41, 0x40, 4)
+        self.assertEqual(0x80, len(data))
+        self.assertEqual([0, 1], list(crcs))
+
+        _, crcs = pages_of(b"\xFF" * 0x40 + b"\x00", 0x40, 4)
+        self.assertEqual([1], list(crcs))
+        _, crcs = pages_of(b"\xFF" * 0x40, 0x40, 1, erased=False)
+        self.assertEqual([0], list(crcs))
+
+        with self.assertRaisesRegex(UpdiError, r"^Over segment Error:"):
+            pages_of(b"\x00" * 0x41, 0x40, 1)
+
+    def test_program(self):
+        flash = bytes([random.randint(0, 0xff) for _ in range(0x50)])
+        result = self.programmer.program(flash=flash, fuses={"OSCCFG": 0x01})
+        self.assertTrue(result.ok)
+        self.assertEqual(2, result.segments["flash"].pages_written)
+        self.assertTrue(result.segments["flash"].verified)
+        start = self.device.FLASH_START_ADDR
+        self.assertEqual(flash, self.link.mem[start:start + 0x50])
+        self.assertEqual(0x01, self.link.mem[self.device.FUSES_base + 0x02])
+
+    def test_blank_userrow(self):
+        start = self.device.USERROW_base
+        self.link.mem[start:start + 3] = b"\x01\x02\x03"
+        result = self.programmer.program(userrow=b"\xFF" * 32)
+        self.assertTrue(result.ok)
+        self.assertEqual(1, result.segments["userrow"].pages_written)
+        self.assertEqual(b"\xFF" * 32, self.link.mem[start:start + 32])
+
+    def test_cached_image(self):
+        hex = IHex()
+        hex.set_memory(0x00, [0x12] * 0x40 + [0xFF] * 0x40)
+        with tempfile.TemporaryDirectory() as dir:
+            file = path.join(dir, "image.img")
+            ImageCache(dir).store(file, hex, self.device)
+            with CachedImage(file) as image:
+                result = self.programmer.program(image=image)
+        self.assertTrue(result.ok)
+        # the explicit blank page is written as the cache lists it
+        self.assertEqual(2, result.segments["flash"].pages_written)
+
+    def test_unknown_fuse(self):
+        result = self.programmer.program(fuses={"NOFUSE": 0x00})
+        self.assertFalse(result.ok)
+        self.assertRegex(str(result.error), r"^Unknown fuse: NOFUSE")
+        # released from NVM programming mode
+        self.assertFalse(self.link.nvmprog)
+
+
+class FuseTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.device = Device.select("ATtiny202")
+        self.link = PlanLink(self.device)
+        fuses = self.device.FUSES_base
+        self.link.mem[fuses:fuses + 0x0B] = bytes(range(0x0B))
+        updi = UPDI(None, device=self.device, transport=self.link)
+        self.updi = UPDI_FUNC(None, device_name=self.device.DEVICE_NAME, updi=updi)
+
+        self.resets = 0
+        control = self.link.control
+
+        def count_reset(reg, value):
+            if reg == self.device.ASI_RESET_REQ and value == self.device.RSTREQ_KEY:
+                self.resets += 1
+            control(reg, value)
+        self.link.control = count_reset
+
+    def test_unchanged(self):
+        fuses = self.updi.write_fuses([0x00, 0x01, 0x02])
+        self.assertEqual([(0x00, 0x00, False), (0x01, 0x01, False), (0x02, 0x02, False)],
+                         fuses)
+        self.assertEqual(0, self.link.stats.fuse_writes)
+        self.assertEqual(0, self.resets)
+
+    def test_changed(self):
+        memory = [None] * 0x0B
+        memory[0x01] = 0x01
+        memory[0x02] = 0x20
+        memory[0x08] = 0x80
+        fuses = self.updi.write_fuses(memory)
+        self.assertEqual([(0x01, 0x01, False), (0x02, 0x20, True), (0x08, 0x80, True)],
+                         fuses)
+        self.assertEqual(2, self.link.stats.fuse_writes)
+        self.assertEqual(1, self.resets)
+        self.assertEqual(b"\x00\x01\x20", self.updi.read_fuses()[:3])
+        self.assertEqual(0x80, self.updi.read_fuses()[0x08])
+
+
+class MonitorTest(unittest.TestCase):
+    class FakeTarget:
+        def __init__(self):
+            self.memory = bytearray(range(0x100)) * 0x100
+            self.reads = []
+
+        def read_data(self, addr, buffer):
+            self.reads.append((addr, len(buffer)))
+            buffer[:] = self.memory[addr:addr + len(buffer)]
+
+    def test_bursts(self):
+        variables = [(0x3F00, 2), (0x3F02, 1), (0x3F01, 2), (0x3F10, 1)]
+        sampler = Sampler(MonitorTest.FakeTarget(), variables)
+        self.assertEqual([(0x3F00, 3), (0x3F10, 1)], sampler.bursts)
+
+    def test_burst_limit(self):
+        sampler = Sampler(MonitorTest.FakeTarget(), [(0x3E00, 0x180)])
+        self.assertEqual([(0x3E00, 0x100), (0x3F00, 0x80)], sampler.bursts)
+
+    def test_values(self):
+        target = MonitorTest.FakeTarget()
+        sampler = Sampler(target, [(0x3F10, 2), (0x3F02, 1), (0x3F11, 1)])
+        sampler.sample()
+        self.assertEqual([(0x3F02, 1), (0x3F10, 2)], target.reads)
+        self.assertEqual([0x1110, 0x02, 0x11], sampler.values())
+
+    def test_csv_file(self):
+        with tempfile.TemporaryDirectory() as dir:
+            file = path.join(dir, "samples.csv")
+            writer = open_samples("csv", file)
+            count, _ = Sampler(MonitorTest.FakeTarget(), [(0x10, 2)]).run(writer, 2)
+            self.assertEqual(2, count)
+            self.assertTrue(writer.out.closed)
+            with open(file) as f:
+                lines = f.read().splitlines()
+        self.assertEqual("time,0010", lines[0])
+        self.assertEqual(["4368", "4368"], [line.split(",")[1] for line in lines[1:]])
+
+
+class ImageCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.hex = IHex()
+        self.hex.read_file(path.dirname(__file__) + "/../sample.hex")
+        self.device = Device.select("ATtiny202")
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_store_load(self):
+        cache = ImageCache(self.dir.name)
+        with cache.load(path.dirname(__file__) + "/../sample.hex", self.device) as image:
+            self.assertEqual([0, 1], image.get_pages(0x00))
+            self.assertEqual(self.hex.get_memory(0x00)[:0x66],
+                             image.get_memory(0x00)[:0x66])
+            self.assertEqual([0x34, 0x12], image.get_memory(0x81)[:2])
+            self.assertEqual(self.hex.get_memory(0x82), image.get_memory(0x82))
+
+    def test_truncated(self):
+        file = path.join(self.dir.name, "broken.img")
+        ImageCache(self.dir.name).store(file, self.hex, self.device)
+        with open(file, "r+b") as f:
+            f.truncate(100)
+        with self.assertRaisesRegex(UpdiError, r"^Cache size Error"):
+            CachedImage(file)
+
+    def test_close_with_slice(self):
+        file = path.join(self.dir.name, "sample.img")
+        ImageCache(self.dir.name).store(file, self.hex, self.device)
+        image = CachedImage(file)
+        data = image.get_data(0x00)
+        image.close()
+        self.assertEqual(0x19, data[0])
+
+
+class DumpTest(unittest.TestCase):
+    def test_hex_dump(self):
+        out = io.StringIO()
+        dump = HexDump(out)
+        dump.segment()
+        dump.write(bytes(range(0x10)))
+        dump.write(b"\xAA\xBB")
+        dump.close()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual("0000: 00 01 02 03 04 05 06 07 08 09 0A 0B 0C 0D 0E 0F", lines[1])
+        self.assertEqual("0010: AA BB", lines[2])
+
+    def test_raw_dump(self):
+        out = io.BytesIO()
+        dump = RawDump(out)
+        dump.segment(0x81)
+        dump.write(b"\x01\x02")
+        dump.write(memoryview(b"\x03"))
+        dump.close()
+        self.assertEqual(b"\x01\x02\x03", out.getvalue())
+
+    def test_ihex_dump(self):
+        out = io.StringIO()
+        dump = IHexDump(out)
+        dump.segment(0x00)
+        dump.write(bytes(range(0x18)))
+        dump.skip(0x08)
+        dump.write(b"\x55")
+        dump.segment(0x81)
+        dump.write(b"\x34\x12")
+        dump.segment(0x00)
+        dump.close()
+
+        hex = IHex()
+        hex.read(out.getvalue().splitlines())
+        self.assertEqual(list(range(0x18)) + [None] * 8 + [0x55],
+                         hex.get_memory(0x00)[:0x21])
+        self.assertEqual([0x34, 0x12, None], hex.get_memory(0x81)[:3])
+        self.assertEqual(":00000001FF", out.getvalue().splitlines()[-1])
+
+
+class BackupTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.device = Device.select("ATtiny202")
+
+        hex = IHex()
+        hex.read_file(path.dirname(__file__) + "/../sample.hex")
+        hex.set_memory(0x83, [0x01, 0x02, 0x03])
+        self.source = self.target(hex)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def target(self, hex=None):
+        link = PlanLink(self.device)
+        updi = UPDI(None, device=self.device, transport=link)
+        target = UPDI_FUNC(None, device_name=self.device.DEVICE_NAME, updi=updi)
+        if hex:
+            with contextlib.redirect_stdout(io.StringIO()):
+                program_hex(target, hex, verify=True)
+        return target
+
+    def assertSameMemory(self, a, b):
+        self.assertEqual(a.read_flash(), b.read_flash())
+        self.assertEqual(a.read_eeprom(), b.read_eeprom())
+        self.assertEqual(a.read_userrow(), b.read_userrow())
+        self.assertEqual(a.read_fuses(), b.read_fuses())
+
+    def test_hex_round_trip(self):
+        file = path.join(self.dir.name, "backup.hex")
+        write_image(read_image(self.source), file, self.device)
+
+        hex = IHex()
+        hex.read_file(file)
+        clone = self.target(hex)
+        self.assertSameMemory(self.source, clone)
+
+    def test_img_round_trip(self):
+        file = path.join(self.dir.name, "backup.img")
+        write_image(read_image(self.source), file, self.device)
+
+        clone = self.target()
+        with CachedImage(file) as image, contextlib.redirect_stdout(io.StringIO()):
+            program_cached(clone, image, verify=True)
+        self.assertSameMemory(self.source, clone)
+
 
 if __name__ == '__main__':
     sys.path.append(path.dirname(__file__) + "/..")
-    from updipy.updipy import UPDI_FUNC
-    from updipy.updi import UPDI
+    from updipy.updipy import UPDI_FUNC, program_hex, program_cached
+    from updipy.updi import UPDI, LinkTimeoutError
+    from updipy.device import Device
+    from updipy.ihex import IHex
+    from updipy.plan import plan, PlanLink
+    from updipy.backup import read_image, write_image
+    from updipy.production import Production
+    from updipy.trace import TraceWriter, read_trace, summarize, replay
+    from updipy.api import Programmer, pages_of
+    from updipy.monitor import Sampler, open_samples
+    from updipy.error import UpdiError
+    from updipy.imagecache import ImageCache, CachedImage
+    from updipy.dump import HexDump, RawDump, IHexDump
 
     if "DEVICE_NAME" in os.environ:
         UpdipyTest.DEVICE_NAME = os.environ.get("DEVICE_NAME")
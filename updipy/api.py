@@ -0,0 +1,230 @@
+import time
+import zlib
+import serial
+
+from .updi import UPDI
+from .ihex import IHex
+from .imagecache import CachedImage
+from .error import UpdiError
+from .updipy import UPDI_FUNC
+
+
+class Throttle:
+    # call callback(done, total) at most once per interval and at the end
+    def __init__(self, callback, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.last = 0.0
+
+    def __call__(self, done, total):
+        now = time.monotonic()
+        if done >= total or now - self.last >= self.interval:
+            self.last = now
+            self.callback(done, total)
+
+
+class SegmentResult:
+    def __init__(self, name):
+        self.name = name
+        self.pages_written = 0
+        self.pages_skipped = 0
+        self.write_time = 0.0
+        self.verify_time = 0.0
+        # None if not verified
+        self.verified = None
+
+    def __repr__(self):
+        return (f"<SegmentResult {self.name}: written={self.pages_written} skipped={self.pages_skipped} "
+                f"verified={self.verified} write={self.write_time:.3f}s verify={self.verify_time:.3f}s>")
+
+
+class Result:
+    def __init__(self):
+        self.device = None
+        self.segments = {}
+        # list of (addr, data, written)
+        self.fuses = []
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and all(
+            [s.verified is not False for s in self.segments.values()])
+
+    def __repr__(self):
+        return (f"<Result {self.device}: ok={self.ok} {self.seconds:.3f}s "
+                f"{list(self.segments.values())} error={self.error!r}>")
+
+
+def pages_of(memory, page_size, page_count, erased=True):
+    # return 0xFF padded bytes and {page: crc32} of non-empty pages.
+    # memory: bytes-like from address 0, or list padded by None.
+    # erased: pages are cleared by chip erase, so blank pages are
+    # skipped. otherwise every given page is written, e.g. user row.
+    nvm_size = page_size * page_count
+    if isinstance(memory, list):
+        if memory[nvm_size:].count(None) != len(memory[nvm_size:]):
+            raise UpdiError(f"Over segment Error: {len(memory) - 1}")
+        memory = memory[:nvm_size]
+        data = bytearray([0xFF if d is None else d for d in memory])
+        pages = [memory[p * page_size:(p + 1) * page_size]
+                 for p in range(page_count)]
+        empty = [page.count(None) == len(page) for page in pages]
+    else:
+        if bytes(memory[nvm_size:]).count(0xFF) != len(memory[nvm_size:]):
+            raise UpdiError(f"Over segment Error: {len(memory) - 1}")
+        data = memory[:nvm_size]
+        blank = b"\xFF" * page_size if erased else None
+        empty = [bytes(data[p * page_size:(p + 1) * page_size]) in (b"", blank)
+                 for p in range(page_count)]
+
+    if len(data) % page_size:
+        data = bytes(data).ljust(len(data) + page_size -
+                                 len(data) % page_size, b"\xFF")
+
+    crcs = {p: zlib.crc32(data[p * page_size:(p + 1) * page_size])
+            for p in range(page_count) if not empty[p]}
+    return data, crcs
+
+
+class Programmer:
+    # program targets in-process without console output.
+    #
+    #   with Programmer("/dev/ttyUSB0", "ATtiny202") as prog:
+    #       result = prog.program(flash=firmware)
+    def __init__(self, port, device_name=None, speed=115200, progress=None,
+                 interval=0.1, transport=None, trace=None):
+        self.device_name = device_name
+        self.progress = Throttle(progress, interval) if progress else None
+        self.updi = UPDI(port, speed, connect=False,
+                         transport=transport, trace=trace)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.updi.close_link()
+
+    def connect(self):
+        # return UPDI_FUNC of the attached target
+        if not self.updi.probe():
+            self.updi.line_break()
+            if not self.updi.probe():
+                raise UpdiError("No target")
+        return UPDI_FUNC(None, device_name=self.device_name,
+                         updi=self.updi, progress=self.progress)
+
+    def program(self, flash=None, eeprom=None, userrow=None, fuses=None,
+                image=None, verify=True):
+        # flash, eeprom, userrow: bytes-like from address 0 or list padded
+        # by None. fuses: {addr or name: value}. image: IHex or
+        # CachedImage supplying the segments not given.
+        start = time.monotonic()
+        result = Result()
+        target = None
+        try:
+            target = self.connect()
+            device = target.device
+            result.device = device.DEVICE_NAME
+
+            flash_crcs = eeprom_crcs = None
+            if image is not None:
+                flash, flash_crcs = self.segment(
+                    image, 0x00, flash, device.FLASH_PAGE_SIZE)
+                eeprom, eeprom_crcs = self.segment(
+                    image, 0x81, eeprom, device.EEPROM_PAGE_SIZE)
+                fuses, _ = self.segment(image, 0x82, fuses)
+                userrow, _ = self.segment(image, 0x83, userrow)
+
+            if flash is not None:
+                self.write(result, "flash", flash,
+                           device.FLASH_PAGE_SIZE, device.FLASH_PAGE_COUNT,
+                           target.write_flash, target.verify_flash, verify,
+                           crcs=flash_crcs)
+            if eeprom is not None:
+                self.write(result, "eeprom", eeprom,
+                           device.EEPROM_PAGE_SIZE, device.EEPROM_PAGE_COUNT,
+                           target.write_eeprom, target.verify_eeprom, verify,
+                           crcs=eeprom_crcs)
+            if userrow is not None:
+                # not cleared by chip erase, blank pages are written too
+                self.write(result, "userrow", userrow,
+                           device.USERROW_SIZE, 1,
+                           target.write_userrow, target.verify_userrow, verify,
+                           erased=False)
+            if fuses is not None:
+                result.fuses = target.write_fuses(self.fuse_list(device, fuses))
+
+            target.release()
+        except (UpdiError, serial.SerialException) as e:
+            result.error = e
+            if target:
+                try:
+                    target.release()
+                except Exception:
+                    # the link may be gone, keep the first error
+                    pass
+        result.seconds = time.monotonic() - start
+        return result
+
+    @staticmethod
+    def segment(image, ext_addr, data, page_size=None):
+        # return data and {page: crc32} precomputed by a CachedImage, or
+        # None. flash and EEPROM are cached in device pages.
+        if data is not None or not image.has_addr(ext_addr):
+            return data, None
+        if isinstance(image, CachedImage) and ext_addr in (0x00, 0x81):
+            if image.page_size(ext_addr) != page_size:
+                raise UpdiError("Image page size Error")
+            return image.get_data(ext_addr), image.get_crcs(ext_addr)
+        return image.get_memory(ext_addr), None
+
+    @staticmethod
+    def fuse_list(device, fuses):
+        if isinstance(fuses, dict):
+            memory = [None for _ in range(max(device.FUSE_BY_ADDR) + 1)]
+            for key, value in fuses.items():
+                if isinstance(key, str):
+                    if key not in device.FUSES:
+                        raise UpdiError(f"Unknown fuse: {key}")
+                    addr = device.FUSES[key]
+                else:
+                    addr = key
+                if addr not in device.FUSE_BY_ADDR:
+                    raise UpdiError("Fuse address Error")
+                memory[addr] = value
+            return memory
+        return list(fuses)
+
+    def write(self, result, name, memory, page_size, page_count, write, verify_func, verify,
+              erased=True, crcs=None):
+        # crcs: {page: crc32} of the pages to write, found from memory if None
+        segment = SegmentResult(name)
+        result.segments[name] = segment
+
+        if crcs is None:
+            data, crcs = pages_of(memory, page_size, page_count, erased)
+        else:
+            data = memory
+        start = time.monotonic()
+        segment.pages_written = write(data, sorted(crcs))
+        segment.pages_skipped = page_count - segment.pages_written
+        segment.write_time = time.monotonic() - start
+
+        if verify:
+            start = time.monotonic()
+            segment.verified = verify_func(crcs)
+            segment.verify_time = time.monotonic() - start
+
+
+def load_image(file):
+    # Intel HEX or cached *.img image
+    if file.endswith(".img"):
+        return CachedImage(file)
+    hex = IHex()
+    hex.read_file(file)
+    return hex
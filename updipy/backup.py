@@ -0,0 +1,47 @@
+import os
+import logging
+
+from .ihex import IHex
+from .imagecache import ImageCache
+
+
+def trim(memory, page_size):
+    # drop trailing erased pages
+    size = len(memory)
+    while size > 0 and memory[size - page_size:size].count(0xFF) == page_size:
+        size -= page_size
+    return memory[:size]
+
+
+def read_image(updi):
+    # read all of flash, EEPROM, fuses and user row into an IHex
+    device = updi.device
+    hex = IHex()
+
+    flash = trim(updi.read_flash(), device.FLASH_PAGE_SIZE)
+    logging.info(f"Flash: {len(flash)} bytes")
+    hex.set_memory(0x00, flash)
+
+    eeprom = trim(updi.read_eeprom(), device.EEPROM_PAGE_SIZE)
+    logging.info(f"EEPROM: {len(eeprom)} bytes")
+    if eeprom:
+        hex.set_memory(0x81, eeprom)
+
+    fuses = updi.read_fuses()
+    hex.set_memory(0x82, [fuse if addr in device.FUSE_BY_ADDR else None
+                          for addr, fuse in enumerate(fuses)])
+
+    userrow = trim(updi.read_userrow(), device.USERROW_SIZE)
+    if userrow:
+        hex.set_memory(0x83, userrow)
+
+    return hex
+
+
+def write_image(hex, file, device):
+    # *.img is the cached image format, others are Intel HEX
+    if file.endswith(".img"):
+        cache = ImageCache(os.path.dirname(os.path.abspath(file)))
+        cache.store(file, hex, device)
+    else:
+        hex.write_file(file)
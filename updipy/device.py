@@ -16,6 +16,7 @@ class Device:
     DEVICE_NAME = "AVR base"
 
     STATUSA = 0x00
+    CTRLA = 0x02
     CTRLB = 0x03
     ASI_KEY_STATUS = 0x07
     ASI_RESET_REQ = 0x08
@@ -25,6 +26,8 @@ class Device:
     ASI_KEY_STATUS_NVMPROG_mask = 0b00010000
     ASI_KEY_STATUS_CHIPERASE_mask = 0b0001000
 
+    CTRLA_RSD_mask = 0b00001000
+
     ASI_SYS_STATUS_NVMPROG_mask = 0b00001000
     ASI_SYS_STATUS_UROWPROG_mask = 0b00000100
     ASI_SYS_STATUS_LOCKSTATUS_mask = 0b00000001
@@ -33,6 +36,7 @@ class Device:
 
     NVMCTRL_base = 0x1000
     NVMCTRL_CTRLA = NVMCTRL_base
+    NVMCTRL_STATUS = NVMCTRL_base + 0x02
     NVMCTRL_DATA = NVMCTRL_base + 0x06
     NVMCTRL_ADDRL = NVMCTRL_base + 0x08
     NVMCTRL_ADDRH = NVMCTRL_base + 0x09
@@ -42,6 +46,10 @@ class Device:
     NVMCTRL_CTRLA_CMD_ERWP = 0x03
     NVMCTRL_CTRLA_CMD_WFU = 0x07
 
+    NVMCTRL_STATUS_WRERROR_mask = 0b00000100
+    NVMCTRL_STATUS_EEBUSY_mask = 0b00000010
+    NVMCTRL_STATUS_FBUSY_mask = 0b00000001
+
     SIGROW_base = 0x1100
     FUSES_base = 0x1280
     USERROW_base = 0x1300
@@ -63,6 +71,8 @@ class TNx02(Device):
     EEPROM_START_ADDR = 0x1400
     EEPROM_PAGE_SIZE = 32
 
+    USERROW_SIZE = 32
+
     FUSES = {
         "WDTCFG": 0x00,
         "BODCFG": 0x01,
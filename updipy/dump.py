@@ -0,0 +1,120 @@
+import sys
+
+
+class HexDump:
+    ROW_SIZE = 0x10
+
+    def __init__(self, out):
+        self.out = out
+        self.addr = 0x0000
+        self.pending = b""
+
+    def segment(self, ext_addr=0x00):
+        self.flush()
+        self.addr = 0x0000
+        self.out.write(" " * 5 + " " +
+                       " ".join([f"{x:2X}" for x in range(HexDump.ROW_SIZE)]) + "\n")
+
+    def write(self, data):
+        data = self.pending + bytes(data)
+        rows = len(data) - len(data) % HexDump.ROW_SIZE
+        lines = []
+        for p in range(0, rows, HexDump.ROW_SIZE):
+            lines.append(
+                f"{self.addr + p:04X}: {data[p:p + HexDump.ROW_SIZE].hex(' ').upper()}\n")
+        self.out.write("".join(lines))
+        self.addr += rows
+        self.pending = data[rows:]
+
+    def flush(self):
+        if self.pending:
+            self.out.write(
+                f"{self.addr:04X}: {self.pending.hex(' ').upper()}\n")
+            self.addr += len(self.pending)
+            self.pending = b""
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+
+
+class RawDump:
+    def __init__(self, out):
+        self.out = out
+
+    def segment(self, ext_addr=0x00):
+        pass
+
+    def write(self, data):
+        self.out.write(data)
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+
+
+class IHexDump:
+    RECORD_SIZE = 0x10
+
+    def __init__(self, out):
+        self.out = out
+        self.ext_addr = 0x00
+        self.addr = 0x0000
+        self.pending = b""
+
+    @staticmethod
+    def record(addr, rtype, data=b""):
+        rec = bytes([len(data), addr >> 8, addr & 0xFF, rtype]) + data
+        checksum = -sum(rec) & 0xFF
+        return f":{rec.hex().upper()}{checksum:02X}\n"
+
+    def segment(self, ext_addr=0x00):
+        self.flush()
+        self.addr = 0x0000
+        if ext_addr != self.ext_addr:
+            self.ext_addr = ext_addr
+            self.out.write(IHexDump.record(
+                0x0000, 0x04, bytes([ext_addr >> 8, ext_addr & 0xFF])))
+
+    def skip(self, size):
+        # leave a hole, e.g. for erased pages
+        self.flush()
+        self.addr += size
+
+    def write(self, data):
+        data = self.pending + bytes(data)
+        rows = len(data) - len(data) % IHexDump.RECORD_SIZE
+        self.out.write("".join([IHexDump.record(self.addr + p, 0x00, data[p:p + IHexDump.RECORD_SIZE])
+                                for p in range(0, rows, IHexDump.RECORD_SIZE)]))
+        self.addr += rows
+        self.pending = data[rows:]
+
+    def flush(self):
+        if self.pending:
+            self.out.write(IHexDump.record(self.addr, 0x00, self.pending))
+            self.addr += len(self.pending)
+            self.pending = b""
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        self.out.write(IHexDump.record(0x0000, 0x01))
+        self.out.flush()
+
+
+FORMATS = {
+    "hex": HexDump,
+    "bin": RawDump,
+    "ihex": IHexDump,
+}
+
+
+def open_dump(format="hex", file=None):
+    binary = format == "bin"
+    if file:
+        out = open(file, "wb" if binary else "w")
+    else:
+        out = sys.stdout.buffer if binary else sys.stdout
+    return FORMATS[format](out)
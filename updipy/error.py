@@ -0,0 +1,6 @@
+class UpdiError(Exception):
+    pass
+
+
+class VerifyError(UpdiError):
+    pass
@@ -1,4 +1,8 @@
 import re
+import logging
+
+from .dump import IHexDump
+from .error import UpdiError
 
 
 class IHex:
@@ -18,13 +22,13 @@ class IHex:
                 continue
             if m := IHex.ihex_pat.search(line):
                 if int(m.group("size"), 16) != (len(m.group("data")) / 2):
-                    print(line)
-                    raise Exception("Data size error")
+                    logging.error(line)
+                    raise UpdiError("Data size error")
                 checksum = sum([int(line[i:(i+2)], 16)
                                 for i in range(1, len(line), 2)]) & 0xFF
                 if checksum != 0:
                     #print(line, hex(checksum))
-                    raise Exception("Checksum Error")
+                    raise UpdiError("Checksum Error")
 
                 if m.group("type") == "00":
                     addr = int(m.group("addr"), 16)
@@ -39,10 +43,10 @@ class IHex:
                         self.memory[self.pointer] = [
                             None for _ in range(0x10000)]
                 else:
-                    raise Exception("Unknow Hex type")
+                    raise UpdiError("Unknow Hex type")
             else:
-                print(line)
-                raise Exception("IHex format Error")
+                logging.error(line)
+                raise UpdiError("IHex format Error")
 
     def read_file(self, file):
         with open(file) as f:
@@ -58,6 +62,34 @@ class IHex:
     def has_addr(self, ext_addr):
         return ext_addr in self.memory
 
+    def set_memory(self, ext_addr, data, addr=0x0000):
+        if ext_addr not in self.memory:
+            self.memory[ext_addr] = [None for _ in range(0x10000)]
+        self.memory[ext_addr][addr:addr + len(data)] = data
+
+    def write(self, out):
+        dump = IHexDump(out)
+        for ext_addr in sorted(self.memory):
+            memory = self.memory[ext_addr]
+            dump.segment(ext_addr)
+            addr = 0
+            while addr < len(memory):
+                # write each run of data and skip holes
+                end = addr
+                while end < len(memory) and memory[end] is not None:
+                    end += 1
+                dump.write(bytes(memory[addr:end]))
+                addr = end
+                while end < len(memory) and memory[end] is None:
+                    end += 1
+                dump.skip(end - addr)
+                addr = end
+        dump.close()
+
+    def write_file(self, file):
+        with open(file, "w") as f:
+            self.write(f)
+
 
 if __name__ == '__main__':
     ihex = IHex()
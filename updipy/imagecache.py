@@ -0,0 +1,184 @@
+import os
+import mmap
+import struct
+import hashlib
+import logging
+import zlib
+
+from .ihex import IHex
+from .error import UpdiError
+
+
+class CachedImage:
+    SEG_SIZE = 0x10000
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = {}
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        try:
+            self.parse()
+        except Exception:
+            self.close()
+            raise
+
+    def parse(self):
+        size = len(self.map)
+        if size < ImageCache.HEADER.size:
+            raise UpdiError("Cache size Error")
+        magic, count = ImageCache.HEADER.unpack_from(self.map, 0)
+        if magic != ImageCache.MAGIC:
+            raise UpdiError("Cache format Error")
+
+        offset = ImageCache.HEADER.size
+        if offset + count * ImageCache.SEGMENT.size > size:
+            raise UpdiError("Cache size Error")
+        for _ in range(count):
+            ext_addr, page_size, page_count, table_offset, data_offset = ImageCache.SEGMENT.unpack_from(
+                self.map, offset)
+            offset += ImageCache.SEGMENT.size
+            if table_offset + page_count * ImageCache.PAGE.size > size or \
+                    data_offset + CachedImage.SEG_SIZE > size:
+                raise UpdiError("Cache size Error")
+            crcs = {}
+            for i in range(page_count):
+                page, crc = ImageCache.PAGE.unpack_from(
+                    self.map, table_offset + i * ImageCache.PAGE.size)
+                crcs[page] = crc
+            self.segments[ext_addr] = (page_size, crcs, data_offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.segments = {}
+        if self.map:
+            self.view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                # get_data() slices are still alive. the map is closed
+                # when the last of them is released.
+                logging.debug(f"Cached image still in use: {self.path}")
+            self.map = None
+
+    def has_addr(self, ext_addr):
+        return ext_addr in self.segments
+
+    def page_size(self, ext_addr=0x00):
+        return self.segments[ext_addr][0]
+
+    def get_pages(self, ext_addr=0x00):
+        return list(self.segments[ext_addr][1])
+
+    def get_crcs(self, ext_addr=0x00):
+        return self.segments[ext_addr][1]
+
+    def get_data(self, ext_addr=0x00):
+        # unwritten bytes are stored as 0xFF
+        data_offset = self.segments[ext_addr][2]
+        return self.view[data_offset:data_offset + CachedImage.SEG_SIZE]
+
+    def get_memory(self, ext_addr=0x00):
+        # like IHex.get_memory() for code expecting None-padded lists.
+        # unwritten bytes in a written page are 0xFF, not None.
+        memory = [None for _ in range(CachedImage.SEG_SIZE)]
+        if ext_addr not in self.segments:
+            return memory
+
+        page_size, crcs, _ = self.segments[ext_addr]
+        data = self.get_data(ext_addr)
+        for page in crcs:
+            addr = page * page_size
+            memory[addr:addr + page_size] = data[addr:addr + page_size]
+        return memory
+
+
+class ImageCache:
+    MAGIC = b"UPDIPYC1"
+    HEADER = struct.Struct("<8sH")
+    # ext_addr, page_size, page_count, table_offset, data_offset
+    SEGMENT = struct.Struct("<HHHII")
+    # page, crc32
+    PAGE = struct.Struct("<HI")
+
+    def __init__(self, cache_dir=None):
+        if not cache_dir:
+            cache_dir = os.path.join(
+                os.environ.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache")),
+                "updipy")
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def page_sizes(device):
+        # flash and EEPROM are cached in device pages, others by byte
+        return {
+            0x00: getattr(device, "FLASH_PAGE_SIZE", 1),
+            0x81: getattr(device, "EEPROM_PAGE_SIZE", 1),
+        }
+
+    def cache_path(self, digest, device):
+        sizes = ImageCache.page_sizes(device)
+        return os.path.join(self.cache_dir, f"{digest}-{sizes[0x00]}-{sizes[0x81]}.img")
+
+    def load(self, file, device):
+        with open(file, "rb") as f:
+            content = f.read()
+        path = self.cache_path(hashlib.sha256(content).hexdigest(), device)
+
+        if os.path.exists(path):
+            try:
+                logging.info(f"Load cached image: {path}")
+                return CachedImage(path)
+            except Exception:
+                logging.warning(f"Broken cache, rebuild: {path}")
+
+        hex = IHex()
+        hex.read(content.decode().splitlines())
+        self.store(path, hex, device)
+        return CachedImage(path)
+
+    def store(self, path, hex, device):
+        sizes = ImageCache.page_sizes(device)
+        segments = []
+        for ext_addr in sorted(hex.memory):
+            page_size = sizes.get(ext_addr, 1)
+            memory = hex.memory[ext_addr]
+            data = bytearray(0xFF if d is None else d for d in memory)
+            pages = []
+            for page in range(CachedImage.SEG_SIZE // page_size):
+                addr = page * page_size
+                if memory[addr:addr + page_size].count(None) == page_size:
+                    continue
+                pages.append(
+                    (page, zlib.crc32(data[addr:addr + page_size])))
+            segments.append((ext_addr, page_size, pages, data))
+
+        offset = ImageCache.HEADER.size + \
+            ImageCache.SEGMENT.size * len(segments)
+        header = ImageCache.HEADER.pack(ImageCache.MAGIC, len(segments))
+        tables = b""
+        datas = b""
+        # data blocks follow all page tables
+        data_offset = offset + sum([ImageCache.PAGE.size * len(pages)
+                                    for _, _, pages, _ in segments])
+        for ext_addr, page_size, pages, data in segments:
+            header += ImageCache.SEGMENT.pack(
+                ext_addr, page_size, len(pages), offset, data_offset + len(datas))
+            offset += ImageCache.PAGE.size * len(pages)
+            tables += b"".join([ImageCache.PAGE.pack(page, crc)
+                                for page, crc in pages])
+            datas += data
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header + tables + datas)
+        os.replace(tmp_path, path)
+        logging.info(f"Stored cached image: {path}")
@@ -0,0 +1,123 @@
+import sys
+import time
+import struct
+
+
+class Sampler:
+    MAX_BURST = 0x100  # REPEAT count is 1 byte
+
+    def __init__(self, updi, variables):
+        # variables: list of (addr, size) read as little-endian unsigned
+        self.updi = updi
+        self.variables = variables
+
+        # merge continuous addresses into bursts
+        addrs = sorted(set([addr + i for addr, size in variables
+                            for i in range(size)]))
+        self.bursts = []
+        for addr in addrs:
+            if self.bursts:
+                start, size = self.bursts[-1]
+                if start + size == addr and size < Sampler.MAX_BURST:
+                    self.bursts[-1] = (start, size + 1)
+                    continue
+            self.bursts.append((addr, 1))
+
+        self.buffer = bytearray(sum([size for _, size in self.bursts]))
+        # offset of each variable in buffer
+        offsets = {}
+        offset = 0
+        for start, size in self.bursts:
+            for i in range(size):
+                offsets[start + i] = offset + i
+            offset += size
+        self.offsets = [(offsets[addr], size) for addr, size in variables]
+
+    def sample(self):
+        # read all bursts into buffer and return the time at the start
+        timestamp = time.perf_counter()
+        with memoryview(self.buffer) as view:
+            offset = 0
+            for start, size in self.bursts:
+                self.updi.read_data(start, view[offset:offset + size])
+                offset += size
+        return timestamp
+
+    def values(self):
+        return [int.from_bytes(self.buffer[offset:offset + size], "little")
+                for offset, size in self.offsets]
+
+    def run(self, writer, count=None, interval=0.0):
+        writer.start(self)
+        done = 0
+        start = time.perf_counter()
+        try:
+            while count is None or done < count:
+                timestamp = self.sample()
+                writer.write(timestamp - start, self)
+                done += 1
+                if interval > 0:
+                    wait = start + done * interval - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.perf_counter() - start
+        writer.close()
+        rate = done / elapsed if elapsed > 0 else 0.0
+        return done, rate
+
+
+class CsvSamples:
+    def __init__(self, out, owned=False):
+        # owned: out was opened for the samples and is closed with them
+        self.out = out
+        self.owned = owned
+
+    def start(self, sampler):
+        self.out.write(",".join(["time"] + [f"{addr:04X}" for addr, _ in sampler.variables]) + "\n")
+
+    def write(self, timestamp, sampler):
+        self.out.write(f"{timestamp:.6f}," +
+                       ",".join([str(v) for v in sampler.values()]) + "\n")
+
+    def close(self):
+        self.out.flush()
+        if self.owned:
+            self.out.close()
+
+
+class BinarySamples:
+    # header: magic, burst count, (start, size) of each burst
+    # record: float64 seconds followed by the bytes of all bursts
+    MAGIC = b"UPDISMP1"
+
+    def __init__(self, out, owned=False):
+        self.out = out
+        self.owned = owned
+
+    def start(self, sampler):
+        self.out.write(BinarySamples.MAGIC +
+                       struct.pack("<H", len(sampler.bursts)))
+        for start, size in sampler.bursts:
+            self.out.write(struct.pack("<HH", start, size))
+
+    def write(self, timestamp, sampler):
+        self.out.write(struct.pack("<d", timestamp))
+        self.out.write(sampler.buffer)
+
+    def close(self):
+        self.out.flush()
+        if self.owned:
+            self.out.close()
+
+
+def open_samples(format="csv", file=None):
+    if format == "bin":
+        if file:
+            return BinarySamples(open(file, "wb"), owned=True)
+        return BinarySamples(sys.stdout.buffer)
+    else:
+        if file:
+            return CsvSamples(open(file, "w"), owned=True)
+        return CsvSamples(sys.stdout)
@@ -0,0 +1,349 @@
+import logging
+import argparse
+
+from .updi import UPDI
+from .device import Device
+from .ihex import IHex
+from .error import UpdiError
+from .api import pages_of
+from .trace import instruction_name
+from .updipy import UPDI_FUNC
+
+
+class PhaseStats:
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        # blocking reads, i.e. USB round trips
+        self.reads = 0
+        # target responses, each preceded by the guard time
+        self.responses = 0
+        self.page_writes = 0
+        self.fuse_writes = 0
+        self.chip_erases = 0
+        self.instructions = {}
+
+    def add(self, other):
+        for key in ("frames", "tx_bytes", "rx_bytes", "reads", "responses",
+                    "page_writes", "fuse_writes", "chip_erases"):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        for name, count in other.instructions.items():
+            self.instructions[name] = self.instructions.get(name, 0) + count
+
+
+class PlanLink:
+    # serial.Serial like simulated target. It answers UPDI frames as a
+    # target would, and counts frames and bytes of each phase.
+    ACK = b"\x40"
+
+    def __init__(self, device):
+        self.device = device
+        self.mem = bytearray(b"\xFF") * 0x10000
+        sig = Device.SIG_BYTES[device.DEVICE_NAME]
+        self.mem[Device.SIGROW_base:Device.SIGROW_base + len(sig)] = sig
+        self.mem[device.NVMCTRL_STATUS] = 0x00
+
+        self.rx = bytearray()
+        self.ptr = 0
+        self.repeat = 1
+        self.pending = None  # ("sts", addr) or ("st", count)
+        self.key = None
+        self.nvmprog = False
+        # response signatures disabled
+        self.rsd = False
+        # NVM command not yet followed by a STATUS poll
+        self.busy = False
+
+        self.phases = {}
+        self.set_phase("connect")
+
+    def set_phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseStats(name)
+        self.stats = self.phases[name]
+
+    def write(self, data):
+        data = bytes(data)
+        self.rx += data  # echo
+        self.stats.frames += 1
+        self.stats.tx_bytes += len(data)
+        name = instruction_name(data)
+        self.stats.instructions[name] = self.stats.instructions.get(
+            name, 0) + 1
+
+        response = self.respond(data)
+        if response:
+            self.rx += response
+            self.stats.rx_bytes += len(response)
+            self.stats.responses += 1
+        return len(data)
+
+    def read(self, size):
+        self.stats.reads += 1
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+    def respond(self, data):
+        if self.pending:
+            return self.respond_data(data)
+
+        if data[0] == UPDI.BREAK:
+            data = data[1:]
+        if len(data) < 2 or data[0] != UPDI.SYNC:
+            raise UpdiError(f"Plan frame Error: {bytes(data).hex()}")
+
+        op = data[1]
+        kind = op & 0b11100000
+        # REPEAT applies only to the next instruction, an LD or ST by pointer
+        if self.repeat > 1 and not (kind in (UPDI.LD, UPDI.ST) and
+                                    (op >> 2) & 0b11 != UPDI.SET_PTR):
+            raise UpdiError(f"Plan REPEAT Error: {op:02X}")
+        if kind == UPDI.LDCS:
+            if (op & 0x0F) == self.device.ASI_SYS_STATUS:
+                status = self.device.ASI_SYS_STATUS_NVMPROG_mask if self.nvmprog else 0
+                return bytes([status])
+            return b"\x00"
+        elif kind == UPDI.STCS:
+            self.control(op & 0x0F, data[2])
+            return b""
+        elif kind == UPDI.REPEAT:
+            self.repeat = data[2] + 1
+            return b""
+        elif (op & 0b11111100) == UPDI.KEY_SET:
+            self.key = data[2:][::-1]
+            return b""
+        elif (op & 0b11111100) == UPDI.KEY_GET:
+            return bytes(8 << (op & 0b11))
+        elif kind == UPDI.LDS:
+            addr = int.from_bytes(data[2:3 + ((op >> 2) & 0b11)], "little")
+            if addr == self.device.NVMCTRL_STATUS:
+                self.busy = False
+            return bytes(self.mem[addr:addr + (op & 0b11) + 1])
+        elif kind == UPDI.STS:
+            addr = int.from_bytes(data[2:3 + ((op >> 2) & 0b11)], "little")
+            if addr >= self.device.NVMCTRL_base:
+                self.check_ready()
+            self.pending = ("sts", addr)
+            return self.ack()
+        elif kind == UPDI.LD:
+            count = self.repeat
+            self.repeat = 1
+            if (op >> 2) & 0b11 == UPDI.SET_PTR:
+                return self.ptr.to_bytes((op & 0b11) + 1, "little")
+            read = bytes(self.mem[self.ptr:self.ptr + count])
+            if (op >> 2) & 0b11 == UPDI.AT_PTR_INC:
+                self.ptr += count
+            return read
+        elif kind == UPDI.ST:
+            if (op >> 2) & 0b11 == UPDI.SET_PTR:
+                self.ptr = int.from_bytes(data[2:], "little")
+                return self.ack()
+            self.check_ready()
+            # a burst sends the repeated data in the same frame
+            burst = data[2:]
+            if len(burst) > self.repeat:
+                raise UpdiError(
+                    f"Plan burst Error: {len(burst)} bytes for {self.repeat}")
+            for value in burst:
+                self.store(value)
+            if self.repeat > len(burst):
+                self.pending = ("st", self.repeat - len(burst))
+            self.repeat = 1
+            return self.ack()
+        return b""
+
+    def respond_data(self, data):
+        if self.pending[0] == "sts":
+            addr = self.pending[1]
+            self.pending = None
+            self.mem[addr:addr + len(data)] = data
+            if addr == self.device.NVMCTRL_CTRLA:
+                self.command(data[0])
+        else:
+            self.store(data[0])
+            count = self.pending[1] - 1
+            self.pending = ("st", count) if count > 0 else None
+        return self.ack()
+
+    def ack(self):
+        return b"" if self.rsd else PlanLink.ACK
+
+    def store(self, value):
+        self.mem[self.ptr] = value
+        self.ptr += 1
+
+    def check_ready(self):
+        # the host has to poll NVMCTRL.STATUS after an NVM command
+        if self.busy:
+            raise UpdiError("Plan NVM busy Error")
+
+    def command(self, cmd):
+        self.busy = True
+        if cmd in (self.device.NVMCTRL_CTRLA_CMD_WP, self.device.NVMCTRL_CTRLA_CMD_ERWP):
+            self.stats.page_writes += 1
+        elif cmd == self.device.NVMCTRL_CTRLA_CMD_WFU:
+            addr = self.mem[self.device.NVMCTRL_ADDRL] | (
+                self.mem[self.device.NVMCTRL_ADDRH] << 8)
+            self.mem[addr] = self.mem[self.device.NVMCTRL_DATA]
+            self.stats.fuse_writes += 1
+
+    def control(self, reg, value):
+        if reg == self.device.ASI_RESET_REQ and value == self.device.RSTREQ_KEY:
+            self.check_ready()
+            if self.key == UPDI.NVMPROG_KEY:
+                self.nvmprog = True
+            elif self.key == UPDI.CHIP_ERASE_KEY:
+                start = self.device.FLASH_START_ADDR
+                self.mem[start:start + self.device.FLASH_PAGE_SIZE *
+                         self.device.FLASH_PAGE_COUNT] = b"\xFF" * (self.device.FLASH_PAGE_SIZE * self.device.FLASH_PAGE_COUNT)
+                self.stats.chip_erases += 1
+            self.key = None
+        elif reg == self.device.CTRLA:
+            self.rsd = (value & self.device.CTRLA_RSD_mask) != 0
+        elif reg == self.device.CTRLB and (value & 0x04):
+            # UPDIDIS
+            self.nvmprog = False
+
+
+class Plan:
+    # typical NVM timing of tinyAVR 0/1 series, used for the estimate
+    PAGE_WRITE_TIME = 0.002
+    FUSE_WRITE_TIME = 0.002
+    CHIP_ERASE_TIME = 0.004
+
+    # guard time inserted by the target before each response, in bits
+    GUARD_BITS = 128
+    # start, 8 data, parity and 2 stop bits
+    BITS_PER_BYTE = 12
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.total = PhaseStats("total")
+        for stats in phases.values():
+            self.total.add(stats)
+
+    def estimate(self, stats, baud=115200, latency=0.001):
+        # seconds on the wire, for USB round trips and NVM busy
+        wire = ((stats.tx_bytes + stats.rx_bytes) * Plan.BITS_PER_BYTE +
+                stats.responses * Plan.GUARD_BITS) / baud
+        nvm = stats.page_writes * Plan.PAGE_WRITE_TIME + \
+            stats.fuse_writes * Plan.FUSE_WRITE_TIME + \
+            stats.chip_erases * Plan.CHIP_ERASE_TIME
+        return wire + stats.reads * latency + nvm
+
+    def summary(self, baud=115200, latency=0.001):
+        # dict to compare protocol efficiency, e.g. in regression tests
+        return {
+            name: {
+                "frames": stats.frames,
+                "tx_bytes": stats.tx_bytes,
+                "rx_bytes": stats.rx_bytes,
+                "reads": stats.reads,
+                "page_writes": stats.page_writes,
+                "fuse_writes": stats.fuse_writes,
+                "seconds": self.estimate(stats, baud, latency),
+            } for name, stats in list(self.phases.items()) + [("total", self.total)]
+        }
+
+    def report(self, baud=115200, latency=0.001):
+        print(f"Baud rate: {baud}, USB latency: {latency * 1000:.1f} ms")
+        print(f"{'Phase':<14}{'frames':>8}{'TX':>8}{'RX':>8}{'reads':>8}{'NVM':>6}{'time [ms]':>11}")
+        for stats in list(self.phases.values()) + [self.total]:
+            nvm = stats.page_writes + stats.fuse_writes + stats.chip_erases
+            print(f"{stats.name:<14}{stats.frames:>8}{stats.tx_bytes:>8}{stats.rx_bytes:>8}"
+                  f"{stats.reads:>8}{nvm:>6}{self.estimate(stats, baud, latency) * 1000:>11.1f}")
+        print()
+        print("Instruction     frames")
+        for name, count in sorted(self.total.instructions.items(), key=lambda kv: -kv[1]):
+            print(f"{name:<12}{count:>10}")
+
+
+def plan(device, hex, verify=True, fuses=None):
+    # run the programming sequence of hex against PlanLink.
+    # fuses: current fuse values of the target, 0xFF if not given.
+    link = PlanLink(device)
+    if fuses:
+        for addr, value in fuses.items():
+            link.mem[device.FUSES_base + addr] = value
+
+    updi = UPDI(None, device=device, transport=link)
+    target = UPDI_FUNC(None, device_name=device.DEVICE_NAME, updi=updi)
+
+    # verify as program_hex() does for updipy -v: one continuous read
+    # from address 0. the user row is not verified there.
+    segments = [
+        (0x00, "flash", device.FLASH_PAGE_SIZE, device.FLASH_PAGE_COUNT,
+         target.write_flash, target.read_flash),
+        (0x81, "eeprom", device.EEPROM_PAGE_SIZE, device.EEPROM_PAGE_COUNT,
+         target.write_eeprom, target.read_eeprom),
+        (0x83, "userrow", device.USERROW_SIZE, 1,
+         target.write_userrow, None),
+    ]
+    for ext_addr, name, page_size, page_count, write, read in segments:
+        if not hex.has_addr(ext_addr):
+            continue
+        memory = hex.get_memory(ext_addr)
+        data, crcs = pages_of(memory, page_size, page_count,
+                              erased=ext_addr != 0x83)
+        if ext_addr != 0x83:
+            link.set_phase("erase")
+            target.chip_erase()
+        link.set_phase(name)
+        write(data, sorted(crcs))
+        read_size = 0x10000 - memory.count(None)
+        if verify and read and read_size:
+            link.set_phase(f"verify {name}")
+            if memory[:read_size] != list(read(size=read_size)):
+                logging.error(f"Plan verify Error: {name}")
+
+    if hex.has_addr(0x82):
+        link.set_phase("fuses")
+        target.write_fuses(hex.get_memory(0x82))
+
+    link.set_phase("close")
+    target.close()
+    return Plan(link.phases)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate UPDI traffic and time without hardware")
+    parser.add_argument("-d", "--device", help="Device name", required=True)
+    parser.add_argument("-i", "--hex", help="hex file", required=True)
+    parser.add_argument("-v", "--verify",
+                        help="Verify FLASH and EEPROM memory", action='store_true')
+    parser.add_argument("-b", "--baud", help="Baud rate",
+                        type=int, default=115200)
+    parser.add_argument("--latency", help="USB round trip latency in ms",
+                        type=float, default=1.0)
+    parser.add_argument("--debug", help="Set debug mode", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.root.setLevel(logging.NOTSET)
+    else:
+        logging.root.setLevel(logging.WARNING)
+
+    device = Device.select(args.device)
+    if device is Device:
+        raise UpdiError(f"Unknown device: {args.device}")
+
+    hex = IHex()
+    hex.read_file(args.hex)
+    plan(device, hex, args.verify).report(args.baud, args.latency / 1000)
+
+
+if __name__ == '__main__':
+    main()
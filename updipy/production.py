@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+import os
+import csv
+import time
+import sqlite3
+import logging
+import argparse
+
+from .error import UpdiError
+from .ihex import IHex
+from .updipy import print_progress
+from .api import Programmer
+
+
+class ProductionLog:
+    FIELDS = ["time", "serial", "device", "result", "seconds", "error"]
+
+    def __init__(self, file):
+        # *.db or *.sqlite is SQLite, others are CSV
+        self.db = None
+        self.csv = None
+        if os.path.splitext(file)[1] in (".db", ".sqlite", ".sqlite3"):
+            self.db = sqlite3.connect(file)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cycles (time TEXT, serial INTEGER, device TEXT, result TEXT, seconds REAL, error TEXT)")
+        else:
+            new_file = not os.path.exists(file)
+            self.csv = open(file, "a", newline="")
+            self.writer = csv.DictWriter(
+                self.csv, fieldnames=ProductionLog.FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def record(self, row):
+        if self.db:
+            self.db.execute("INSERT INTO cycles VALUES (?, ?, ?, ?, ?, ?)",
+                            [row[k] for k in ProductionLog.FIELDS])
+            self.db.commit()
+        else:
+            self.writer.writerow(row)
+            self.csv.flush()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+        else:
+            self.csv.close()
+
+
+class Production:
+    # consecutive failed probes before a target is taken as removed
+    REMOVE_PROBES = 5
+
+    def __init__(self, port, hex, speed=115200, device_name=None, verify=True,
+                 serial_addr=None, serial=0, serial_size=4, log=None, interval=0.1,
+                 transport=None):
+        self.programmer = Programmer(port, device_name, speed,
+                                     progress=print_progress, transport=transport)
+        self.updi = self.programmer.updi
+        self.hex = hex
+        self.verify = verify
+        # serial number patched into EEPROM at serial_addr
+        self.serial_addr = serial_addr
+        self.serial = serial
+        self.serial_size = serial_size
+        self.log = log
+        self.interval = interval
+
+    def close(self):
+        self.programmer.close()
+        if self.log:
+            self.log.close()
+
+    def wait_target(self, present=True, count=1):
+        # count: consecutive probes to agree, as a released target may
+        # miss a single probe
+        matched = 0
+        while True:
+            matched = matched + 1 if self.updi.probe() == present else 0
+            if matched >= count:
+                return
+            time.sleep(self.interval)
+
+    def program(self):
+        if self.serial_addr is not None:
+            self.hex.set_memory(0x81, list(self.serial.to_bytes(
+                self.serial_size, "little")), self.serial_addr)
+
+        row = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "serial": self.serial if self.serial_addr is not None else None,
+            "device": None,
+            "result": "OK",
+            "seconds": None,
+            "error": None,
+        }
+        # each written page is verified by its CRC
+        result = self.programmer.program(image=self.hex, verify=self.verify)
+        row["device"] = result.device
+        row["seconds"] = round(result.seconds, 3)
+        if result.ok:
+            if self.serial_addr is not None:
+                self.serial += 1
+        else:
+            if result.error:
+                error = str(result.error)
+            else:
+                failed = [name for name, segment in result.segments.items()
+                          if segment.verified is False]
+                error = f"Verify Error: {', '.join(failed)}"
+            logging.error(f"Production Error: {error}")
+            row["result"] = "NG"
+            row["error"] = error
+
+        if self.log:
+            self.log.record(row)
+        return row
+
+    def run(self, count=None):
+        done = 0
+        while count is None or done < count:
+            print("Waiting for target ...")
+            self.wait_target(True)
+            row = self.program()
+            done += 1
+            print(
+                f"[{done}] {row['result']} {row['device']} serial: {row['serial']} ({row['seconds']} s)")
+            print("Remove target.")
+            self.wait_target(False, Production.REMOVE_PROBES)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Program each newly attached target")
+    parser.add_argument("-l", "--line", help="port path", required=True)
+    parser.add_argument("-d", "--device", help="Device name")
+    parser.add_argument("-i", "--hex", help="hex file", required=True)
+    parser.add_argument("--no-verify", help="Skip verify",
+                        action='store_true')
+    parser.add_argument("-s", "--serial-number",
+                        help="Write incremental serial number ADDR:START to EEPROM")
+    parser.add_argument("--serial-size", help="Bytes of serial number",
+                        type=int, default=4)
+    parser.add_argument("--log", help="CSV or SQLite (*.db) log file")
+    parser.add_argument("-n", "--count", help="Number of targets", type=int)
+    parser.add_argument("--debug", help="Set debug mode", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.root.setLevel(logging.NOTSET)
+    else:
+        logging.root.setLevel(logging.WARNING)
+
+    hex = IHex()
+    hex.read_file(args.hex)
+
+    serial_addr = None
+    serial = 0
+    if args.serial_number:
+        kv = args.serial_number.split(':')
+        if len(kv) != 2:
+            logging.error(f"Format Error: {kv}")
+            raise UpdiError("Serial number format Error")
+        serial_addr = int(kv[0], 16)
+        serial = int(kv[1], 0)
+
+    production = Production(args.line, hex, device_name=args.device,
+                            verify=not args.no_verify, serial_addr=serial_addr,
+                            serial=serial, serial_size=args.serial_size,
+                            log=ProductionLog(args.log) if args.log else None)
+    try:
+        production.run(args.count)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        production.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+import time
+import struct
+import logging
+import argparse
+
+from .updi import UPDI
+from .error import UpdiError
+
+
+class TraceWriter:
+    # header: magic, baud rate
+    # record: direction, start ns, end ns, size, data
+    MAGIC = b"UPDITRC1"
+    HEADER = struct.Struct("<8sI")
+    RECORD = struct.Struct("<BQQH")
+    TX = 0
+    RX = 1
+
+    def __init__(self, file, speed=115200):
+        self.out = open(file, "wb")
+        self.out.write(TraceWriter.HEADER.pack(TraceWriter.MAGIC, speed))
+        self.origin = time.perf_counter_ns()
+
+    def record(self, direction, data, start, end):
+        self.out.write(TraceWriter.RECORD.pack(
+            direction, start - self.origin, end - self.origin, len(data)))
+        self.out.write(data)
+
+    def close(self):
+        self.out.close()
+
+
+def read_trace(file):
+    # return baud rate and list of (direction, start ns, end ns, data)
+    with open(file, "rb") as f:
+        content = f.read()
+    magic, speed = TraceWriter.HEADER.unpack_from(content, 0)
+    if magic != TraceWriter.MAGIC:
+        raise UpdiError("Trace format Error")
+
+    records = []
+    offset = TraceWriter.HEADER.size
+    while offset < len(content):
+        direction, start, end, size = TraceWriter.RECORD.unpack_from(
+            content, offset)
+        offset += TraceWriter.RECORD.size
+        records.append((direction, start, end,
+                        content[offset:offset + size]))
+        offset += size
+    return speed, records
+
+
+def instruction_name(data):
+    if len(data) < 2 or data[0] != UPDI.SYNC:
+        return "DATA"
+    opcode = data[1] & 0b11100000
+    if opcode == UPDI.LD and (data[1] >> 2) & 0b11 == UPDI.SET_PTR:
+        return "LD PTR"
+    if opcode == UPDI.ST and (data[1] >> 2) & 0b11 == UPDI.SET_PTR:
+        return "ST PTR"
+    if opcode == UPDI.KEY_SET & 0b11100000:
+        return "KEY"
+    return {
+        UPDI.LDS: "LDS",
+        UPDI.STS: "STS",
+        UPDI.LD: "LD",
+        UPDI.ST: "ST",
+        UPDI.LDCS: "LDCS",
+        UPDI.STCS: "STCS",
+        UPDI.REPEAT: "REPEAT",
+    }.get(opcode, "UNKNOWN")
+
+
+POINTER_INSTRUCTIONS = ("ST PTR", "REPEAT", "LD", "ST")
+
+
+def add_cost(table, key, count, cost):
+    prev_count, prev_cost = table.get(key, (0, 0))
+    table[key] = (prev_count + count, prev_cost + cost)
+
+
+def summarize(records):
+    summary = {
+        "frames": len(records),
+        "tx_bytes": 0,
+        "rx_bytes": 0,
+        "timeouts": 0,
+        "total": 0,
+        "busy": 0,
+        "idle": 0,
+        "max_idle": 0,
+        "instructions": {},
+        "pointers": {},
+    }
+    if not records:
+        return summary
+
+    summary["total"] = records[-1][2] - records[0][1]
+    last_end = records[0][1]
+    instruction = None
+    pointer = None
+    for i, (direction, start, end, data) in enumerate(records):
+        summary["busy"] += end - start
+        gap = max(0, start - last_end)
+        summary["idle"] += gap
+        summary["max_idle"] = max(summary["max_idle"], gap)
+        last_end = end
+
+        if direction == TraceWriter.TX:
+            summary["tx_bytes"] += len(data)
+            # an instruction costs until the next instruction starts
+            if i + 1 < len(records):
+                cost = records[i + 1][1] - start
+            else:
+                cost = end - start
+            name = instruction_name(data)
+            if name == "DATA":
+                # data of STS or repeated ST belongs to the instruction
+                name = instruction or name
+                add_cost(summary["instructions"], name, 0, cost)
+            else:
+                instruction = name
+                add_cost(summary["instructions"], name, 1, cost)
+            if name == "ST PTR" and len(data) > 3:
+                pointer = data[2] | (data[3] << 8)
+            # only the pointer accesses, not STS or LDS polls between them
+            if pointer is not None and name in POINTER_INSTRUCTIONS:
+                add_cost(summary["pointers"], pointer, 1, cost)
+        else:
+            summary["rx_bytes"] += len(data)
+            if len(data) == 0:
+                summary["timeouts"] += 1
+    return summary
+
+
+def print_summary(speed, summary, top=10):
+    ms = 1e-6
+    print(f"Baud rate: {speed}")
+    print(f"Frames: {summary['frames']} (TX {summary['tx_bytes']} bytes, RX {summary['rx_bytes']} bytes, {summary['timeouts']} timeouts)")
+    print(f"Total: {summary['total'] * ms:.1f} ms, link: {summary['busy'] * ms:.1f} ms, idle: {summary['idle'] * ms:.1f} ms (max gap {summary['max_idle'] * ms:.3f} ms)")
+    print()
+    print("Instruction     count   time [ms]")
+    for name, (count, total) in sorted(summary["instructions"].items(),
+                                       key=lambda kv: -kv[1][1]):
+        print(f"{name:<12}{count:>9}{total * ms:>12.1f}")
+    print()
+    print("Pointer         frames  time [ms]")
+    for addr, (count, total) in sorted(summary["pointers"].items(),
+                                       key=lambda kv: -kv[1][1])[:top]:
+        print(f"{addr:04X}{count:>17}{total * ms:>12.1f}")
+
+
+class ReplayLink:
+    # serial.Serial like transport returning the recorded responses.
+    # with realtime, each response is delayed as recorded.
+    def __init__(self, records, realtime=True):
+        self.records = records
+        self.realtime = realtime
+        self.index = 0
+        self.pending = None
+        self.origin = None
+        self.delay = 0
+
+    def wait(self, end):
+        if not self.realtime:
+            return
+        if self.origin is None:
+            self.origin = time.perf_counter_ns() - end
+        wait = self.origin + end - time.perf_counter_ns()
+        if wait > 0:
+            time.sleep(wait * 1e-9)
+        else:
+            # host is late, keep the recorded gaps from now
+            self.delay -= wait
+            self.origin -= wait
+
+    def next_record(self, direction):
+        while self.index < len(self.records):
+            record = self.records[self.index]
+            self.index += 1
+            if record[0] == direction:
+                return record
+            if record[0] == TraceWriter.RX and not record[3]:
+                # timeout
+                continue
+            logging.warning(f"Replay skipped a frame at {record[1]} ns")
+        return None
+
+    def write(self, data):
+        record = self.next_record(TraceWriter.TX)
+        if record is None:
+            logging.warning("Replay trace ended")
+            self.pending = None
+            return len(data)
+        if record[3] != bytes(data):
+            logging.warning(
+                f"Replay differs: {bytes(data).hex()} != {record[3].hex()}")
+        self.pending = (record[2], bytes(data))
+        return len(data)
+
+    def read(self, size):
+        if self.pending:
+            end, echo = self.pending
+            self.pending = None
+            self.wait(end)
+            return echo[:size]
+
+        record = self.next_record(TraceWriter.RX)
+        if record is None:
+            return b""
+        self.wait(record[2])
+        return record[3][:size]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def replay(records, realtime=True):
+    # send the recorded frames again through UPDI and ReplayLink
+    link = ReplayLink(records, realtime)
+    updi = UPDI(None, transport=link, connect=False)
+    start = time.perf_counter_ns()
+    for direction, _, _, data in records:
+        if direction == TraceWriter.TX:
+            updi.write_link(data, sync=False)
+        elif data:
+            updi.read_link(len(data))
+    elapsed = time.perf_counter_ns() - start
+    return elapsed, link.delay
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze UPDI link trace")
+    parser.add_argument("command", choices=["summary", "replay"])
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("--top", help="Number of pointers to show",
+                        type=int, default=10)
+    parser.add_argument("--fast", help="Replay without recorded delays",
+                        action='store_true')
+    parser.add_argument("--debug", help="Set debug mode", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.root.setLevel(logging.NOTSET)
+    else:
+        logging.root.setLevel(logging.WARNING)
+
+    speed, records = read_trace(args.trace)
+    if args.command == "summary":
+        print_summary(speed, summarize(records), args.top)
+    else:
+        recorded = records[-1][2] - records[0][1] if records else 0
+        elapsed, delay = replay(records, not args.fast)
+        print(f"Recorded: {recorded * 1e-6:.1f} ms")
+        print(f"Replayed: {elapsed * 1e-6:.1f} ms (host late by {delay * 1e-6:.1f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,10 @@ import time
 import sys
 
 from .device import Device
+from .error import UpdiError
 
 
-class LinkTimeoutError(Exception):
+class LinkTimeoutError(UpdiError):
     pass
 
 
@@ -39,23 +40,40 @@ class UPDI:
     KEY_SIZE_8 = 0b00  # 8 bytes
     KEY_SIZE_16 = 0b01  # 16 bytes
 
-    INIT_SEQ = [BREAK, SYNC, 0xC3, 0x08]  # important set CTRLB.CCDETDIS=1
+    # important set CTRLB.CCDETDIS=1
+    INIT_SEQ = bytes([BREAK, SYNC, 0xC3, 0x08])
 
-    CHIP_ERASE_KEY = [0x4E, 0x56, 0x4D, 0x45, 0x72, 0x61, 0x73, 0x65]
-    NVMPROG_KEY = [0x4E, 0x56, 0x4D, 0x50, 0x72, 0x6F, 0x67, 0x20]
-    USERROW_WRITE_KEY = [0x4E, 0x56, 0x4D, 0x55, 0x73, 0x26, 0x74, 0x65]
+    CHIP_ERASE_KEY = b"NVMErase"
+    NVMPROG_KEY = b"NVMProg "
+    USERROW_WRITE_KEY = b"NVMUs&te"
 
-    def __init__(self, port, speed=115200, device=Device):
+    def __init__(self, port, speed=115200, device=Device, connect=True,
+                 transport=None, trace=None):
+        # transport: serial.Serial like object used instead of port
+        # trace: TraceWriter to record frames
         self.link = None
+        self.transport = transport
+        self.trace = trace
+        # reused for every frame
+        self.frame = bytearray()
+        self.echo = bytearray(0x100)
         self.port = port
         self.speed = speed
         self.device = device
-        self.open()
+        if connect:
+            self.open()
+        else:
+            # open only the adapter, e.g. to wait for a target
+            self.open_link()
 
     def set_device(self, device):
         self.device = device
 
     def open_link(self):
+        if self.transport:
+            self.link = self.transport
+            return
+
         logging.info("Open " + self.port)
         if self.link:
             self.link.close()
@@ -80,32 +98,78 @@ class UPDI:
             self.link.close()
 
     def write_link(self, data, sync=True):
+        # data: bytes-like
+        frame = self.frame
+        del frame[:]
         if sync:
-            data = [UPDI.SYNC] + data
-        self.link.write(data)
-        _echo = self.link.read(len(data))
-        logging.debug("TxD:" + ", ".join(["{:02X}".format(c) for c in _echo]))
+            frame.append(UPDI.SYNC)
+        frame += data
+        if self.trace:
+            start = time.perf_counter_ns()
+        self.link.write(frame)
+
+        size = len(frame)
+        if size > len(self.echo):
+            self.echo = bytearray(size)
+        with memoryview(self.echo) as echo:
+            read = self.link.readinto(echo[:size])
+            if self.trace:
+                self.trace.record(self.trace.TX, frame,
+                                  start, time.perf_counter_ns())
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("TxD:" + echo[:read].hex(", ").upper())
+        if read < size:
+            logging.error(f"Link echo Timeout: {read}/{size} bytes")
+            raise LinkTimeoutError("Timeout")
 
     def read_link(self, size):
         if size == 0:
-            return []
+            return b""
 
+        if self.trace:
+            start = time.perf_counter_ns()
         _read = self.link.read(size)
+        if self.trace:
+            self.trace.record(self.trace.RX, _read,
+                              start, time.perf_counter_ns())
         if not _read:
             logging.error("Link read Timeout")
             raise LinkTimeoutError("Timeout")
-        logging.debug("RxD:" + ", ".join(["{:02X}".format(c) for c in _read]))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("RxD:" + _read.hex(", ").upper())
         return _read
 
+    def read_link_into(self, buffer):
+        # read len(buffer) bytes into writable buffer
+        if len(buffer) == 0:
+            return 0
+
+        if self.trace:
+            start = time.perf_counter_ns()
+        read = self.link.readinto(buffer)
+        if self.trace:
+            self.trace.record(self.trace.RX, buffer[:read],
+                              start, time.perf_counter_ns())
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("RxD:" + bytes(buffer[:read]).hex(", ").upper())
+        if read < len(buffer):
+            # the rest of buffer would silently keep stale bytes
+            logging.error(f"Link read Timeout: {read}/{len(buffer)} bytes")
+            raise LinkTimeoutError("Timeout")
+        return read
+
     def line_break(self):
         self.close_link()
+        if self.transport:
+            self.open_link()
+            return
 
         comm = serial.Serial(port=self.port, baudrate=300,
                              bytesize=serial.EIGHTBITS,
                              parity=serial.PARITY_EVEN,
                              stopbits=serial.STOPBITS_TWO)
         logging.debug("Send double break")
-        comm.write([UPDI.BREAK, UPDI.BREAK])
+        comm.write(bytes([UPDI.BREAK, UPDI.BREAK]))
         comm.read(2)
         comm.close()
 
@@ -114,7 +178,7 @@ class UPDI:
     def open(self):
         self.open_link()
         self.write_link(UPDI.INIT_SEQ, sync=False)
-        cmd = [UPDI.LDCS | self.device.STATUSA]  # read STATUSA any reg. OK
+        cmd = bytes([UPDI.LDCS | self.device.STATUSA])  # read STATUSA any reg. OK
         self.write_link(cmd)
         try:
             self.read_link(1)
@@ -124,9 +188,22 @@ class UPDI:
             self.write_link(cmd)
             self.read_link(1)
 
-    def close(self):
-        data = [0xC3, 0x04]  # set CTRLB.UPDIDIS=1
+    def probe(self):
+        # cheap check of a target on the line without the slow line_break()
+        try:
+            self.write_link(UPDI.INIT_SEQ, sync=False)
+            self.write_link(bytes([UPDI.LDCS | self.device.STATUSA]))
+            self.read_link(1)
+        except LinkTimeoutError:
+            return False
+        return True
+
+    def disable(self):
+        data = bytes([0xC3, 0x04])  # set CTRLB.UPDIDIS=1
         self.write_link(data)
+
+    def close(self):
+        self.disable()
         self.close_link()
 
     def req_reset(self):
@@ -136,54 +213,54 @@ class UPDI:
     def get_key(self, long=False):
         if long:
             cmd = UPDI.KEY_GET | UPDI.KEY_SIZE_16
-            self.write_link([cmd])
+            self.write_link(bytes([cmd]))
             key = self.read_link(16)
         else:
             cmd = UPDI.KEY_GET | UPDI.KEY_SIZE_8
-            self.write_link([cmd])
+            self.write_link(bytes([cmd]))
             key = self.read_link(8)
         return key
 
     def set_key(self, key):
-        cmd = [UPDI.KEY_SET | UPDI.KEY_SIZE_8] + [c for c in reversed(key)]
+        cmd = bytes([UPDI.KEY_SET | UPDI.KEY_SIZE_8]) + bytes(key[::-1])
         self.write_link(cmd)
 
     # UPDI instructions
     def ldcs(self, addr):
-        cmd = [UPDI.LDCS | addr]
+        cmd = bytes([UPDI.LDCS | addr])
         self.write_link(cmd)
         return self.read_link(1)
 
     def stcs(self, addr, data):
-        cmd = [UPDI.STCS | addr, data]
+        cmd = bytes([UPDI.STCS | addr, data])
         self.write_link(cmd)
 
     def lds(self, addr, data_size=DATA_SIZE_1):
         if addr > 0xFF:
             addr_size = UPDI.ADDR_SIZE_2
-            cmd = [UPDI.LDS | (addr_size << 2) | data_size,
-                   addr & 0xFF, addr >> 8]
+            cmd = bytes([UPDI.LDS | (addr_size << 2) | data_size,
+                         addr & 0xFF, addr >> 8])
         else:
             addr_size = UPDI.ADDR_SIZE_1
-            cmd = [UPDI.LDS | (addr_size << 2) | data_size, addr]
+            cmd = bytes([UPDI.LDS | (addr_size << 2) | data_size, addr])
         self.write_link(cmd)
         return self.read_link(data_size + 1)
 
     def sts(self, addr, data):
         if data > 0xFF:
             data_size = UPDI.DATA_SIZE_2
-            data_array = [data & 0xFF, data >> 8]
+            data_array = bytes([data & 0xFF, data >> 8])
         else:
             data_size = UPDI.DATA_SIZE_1
-            data_array = [data]
+            data_array = bytes([data])
 
         if addr > 0xFF:
             addr_size = UPDI.ADDR_SIZE_2
-            cmd = [UPDI.STS | (addr_size << 2) | data_size,
-                   addr & 0xFF, addr >> 8]
+            cmd = bytes([UPDI.STS | (addr_size << 2) | data_size,
+                         addr & 0xFF, addr >> 8])
         else:
             addr_size = UPDI.ADDR_SIZE_1
-            cmd = [UPDI.STS | (addr_size << 2) | data_size, addr]
+            cmd = bytes([UPDI.STS | (addr_size << 2) | data_size, addr])
         self.write_link(cmd)
         self.read_link(1)
 
@@ -191,30 +268,51 @@ class UPDI:
         self.read_link(1)
 
     def ld(self, pt_access, data_size=DATA_SIZE_1):
-        cmd = [UPDI.LD | (pt_access << 2) | data_size]
+        cmd = bytes([UPDI.LD | (pt_access << 2) | data_size])
         self.write_link(cmd)
         return self.read_link(data_size + 1)
 
     def st(self, pt_access, data):
-        if data > 0xFF:
+        # pointer is always set by word, e.g. for I/O registers below 0x100
+        if data > 0xFF or pt_access == UPDI.SET_PTR:
             data_size = UPDI.DATA_SIZE_2
-            cmd = [UPDI.ST | (pt_access << 2) | data_size,
-                   data & 0xFF, data >> 8]
+            cmd = bytes([UPDI.ST | (pt_access << 2) | data_size,
+                         data & 0xFF, data >> 8])
         else:
             data_size = UPDI.DATA_SIZE_1
-            cmd = [UPDI.ST | (pt_access << 2) | data_size, data]
+            cmd = bytes([UPDI.ST | (pt_access << 2) | data_size, data])
         self.write_link(cmd)
         self.read_link(1)
 
     def repeat(self, data_size):
         if data_size > 0:
-            cmd = [UPDI.REPEAT | UPDI.DATA_SIZE_1, data_size & 0xFF]
+            cmd = bytes([UPDI.REPEAT | UPDI.DATA_SIZE_1, data_size & 0xFF])
             self.write_link(cmd)
 
     def repeat_write(self, data):
-        for d in data:
-            self.write_link([d & 0xFF], sync=False)
-            self.read_link(1)
+        # data: bytes-like or list of int
+        if isinstance(data, list):
+            data = bytes(data)
+        with memoryview(data) as view:
+            for i in range(len(view)):
+                self.write_link(view[i:i + 1], sync=False)
+                self.read_link(1)
+
+    def burst_write(self, data):
+        # store data from the pointer in one frame instead of a frame
+        # and an ACK per byte. response signatures are disabled while
+        # sending, so the target does not ACK each byte. REPEAT applies
+        # to the next instruction, so it goes right before the ST.
+        self.stcs(self.device.CTRLA, self.device.CTRLA_RSD_mask)
+        self.repeat(len(data) - 1)
+        frame = bytearray(
+            [UPDI.ST | (UPDI.AT_PTR_INC << 2) | UPDI.DATA_SIZE_1])
+        frame.extend(data)
+        self.write_link(frame)
+        self.stcs(self.device.CTRLA, 0x00)
 
     def repeat_read(self, data_size):
         return self.read_link(data_size)
+
+    def repeat_read_into(self, buffer):
+        return self.read_link_into(buffer)
@@ -4,22 +4,40 @@ import time
 import logging
 import shutil
 import argparse
+import zlib
+import sys
 
 from .updi import UPDI
+from .error import UpdiError, VerifyError
 from .device import Device
 from .ihex import IHex
+from .imagecache import ImageCache, CachedImage
+from .backup import read_image, write_image
+from .dump import open_dump
+from .monitor import Sampler, open_samples
+from .trace import TraceWriter
 
 
 class UPDI_FUNC:
-    def __init__(self, port, speed=115200, device_name=None):
+    def __init__(self, port, speed=115200, device_name=None, updi=None, trace=None,
+                 progress=None):
+        # updi: opened UPDI to be reused instead of opening port
+        # trace: TraceWriter to record the link traffic
+        # progress: called with (done, total) pages while writing
         self.chip_erased = False
+        self.progress = progress
         self.device = Device.select(device_name)
-        self.updi = UPDI(port=port, speed=speed, device=self.device)
+        if updi:
+            self.updi = updi
+            self.updi.set_device(self.device)
+        else:
+            self.updi = UPDI(port=port, speed=speed, device=self.device,
+                             trace=trace)
         if device_name:
             connected_dev = self.get_device_name()
             if device_name.upper() != connected_dev.upper():
                 self.reset()
-                raise Exception(
+                raise UpdiError(
                     f"Device ID Error: not {device_name} but {connected_dev}")
         else:
             device_name = self.get_device_name()
@@ -32,6 +50,22 @@ class UPDI_FUNC:
         self.updi.req_reset()
         self.updi.close()
 
+    def release(self):
+        # start the target but keep the link open for the next one
+        self.updi.req_reset()
+        self.updi.disable()
+
+    def resume(self):
+        # leave NVM programming mode and run CPU with UPDI enabled
+        self.release()
+        if not self.updi.probe():
+            raise UpdiError("Resume Error")
+
+    def read_data(self, addr, buffer):
+        # read data space, e.g. SRAM and I/O registers, without unlock
+        self.updi.st(UPDI.SET_PTR, addr)
+        self.load(buffer)
+
     def unlock_nvm(self):
         status = self.updi.ldcs(self.device.ASI_SYS_STATUS)
         if (status[0] & self.device.ASI_SYS_STATUS_NVMPROG_mask) != 0:
@@ -47,7 +81,7 @@ class UPDI_FUNC:
             if (status[0] & self.device.ASI_SYS_STATUS_NVMPROG_mask) != 0:
                 break
             elif count > 3:
-                raise Exception("Unlock Error")
+                raise UpdiError("Unlock Error")
             else:
                 time.sleep(0.2)
                 count += 1
@@ -58,11 +92,12 @@ class UPDI_FUNC:
         self.unlock_nvm()
 
         self.updi.st(UPDI.SET_PTR, Device.SIGROW_base)
-        self.updi.repeat(0x02)
-        dev_id = self.updi.ld(UPDI.AT_PTR_INC)
-        dev_id += self.updi.repeat_read(0x02)
-        sig = "".join([f"{sig:02X}" for sig in dev_id])
+        dev_id = bytearray(3)
+        self.load(dev_id)
+        sig = dev_id.hex().upper()
         logging.info(f"Device ID: {sig}")
+        if sig not in Device.NAME_BY_SIG:
+            raise UpdiError(f"Unknown device: {sig}")
         dev_name = Device.NAME_BY_SIG[sig]
         logging.info(f"Device name: {dev_name}")
         return dev_name
@@ -83,7 +118,7 @@ class UPDI_FUNC:
                 logging.info("Chip erased")
                 break
             elif count > 3:
-                raise Exception("Chip erase Error")
+                raise UpdiError("Chip erase Error")
             else:
                 count += 1
                 time.sleep(0.2)
@@ -93,52 +128,75 @@ class UPDI_FUNC:
         self.unlock_nvm()
 
         self.updi.st(UPDI.SET_PTR, self.device.FUSES_base)
-        data = []
-        repeat_count = max(self.device.FUSE_BY_ADDR)
-        self.updi.repeat(repeat_count)
-        data += self.updi.ld(UPDI.AT_PTR_INC)
-        data += self.updi.repeat_read(repeat_count)
+        data = bytearray(max(self.device.FUSE_BY_ADDR) + 1)
+        self.load(data)
         return data
 
     def write_fuse(self, addr, data):
         if addr not in self.device.FUSE_BY_ADDR:
             logging.error(f"No fuse at {addr:02X}")
-            raise Exception("Fuse address Error")
-
-        self.unlock_nvm()
+            raise UpdiError("Fuse address Error")
 
-        ph_addr = self.device.FUSES_base + addr
-        # updi.sts(device.NVMCTRL_ADDRL, addr) # writing word not write high byte
-        self.updi.sts(self.device.NVMCTRL_ADDRL, ph_addr & 0xFF)
-        self.updi.sts(self.device.NVMCTRL_ADDRH, ph_addr >> 8)
-        self.updi.sts(self.device.NVMCTRL_DATA, data & 0xFF)
-        self.updi.sts(self.device.NVMCTRL_CTRLA,
-                      self.device.NVMCTRL_CTRLA_CMD_WFU)
+        memory = [None for _ in range(addr + 1)]
+        memory[addr] = data
+        self.write_fuses(memory)
 
-        self.reset()
+    def wait_nvm_ready(self, timeout=0.5):
+        busy_mask = self.device.NVMCTRL_STATUS_FBUSY_mask | self.device.NVMCTRL_STATUS_EEBUSY_mask
+        limit = time.monotonic() + timeout
+        while True:
+            status = self.updi.lds(self.device.NVMCTRL_STATUS)[0]
+            if (status & self.device.NVMCTRL_STATUS_WRERROR_mask) != 0:
+                raise UpdiError("NVM write Error")
+            if (status & busy_mask) == 0:
+                return
+            if time.monotonic() > limit:
+                raise UpdiError("NVM busy Timeout")
+
+    def store(self, addr, data):
+        # write continuous registers in one ST burst
+        self.updi.st(UPDI.SET_PTR, addr)
+        self.updi.burst_write(data)
+
+    def load(self, buffer):
+        # read len(buffer) bytes from the pointer in one LD burst
+        self.updi.repeat(len(buffer) - 1)
+        buffer[0] = self.updi.ld(UPDI.AT_PTR_INC)[0]
+        with memoryview(buffer) as view:
+            self.updi.repeat_read_into(view[1:])
 
     def write_fuses(self, memory):
-        self.unlock_nvm()
+        # write only the fuses different from the current value, then
+        # reset once. return list of (addr, data, written).
+        current = self.read_fuses()
 
-        max_len = max([len(k) for k in self.updi.device.FUSES.keys()])
+        fuses = []
+        written = 0
         for addr in self.device.FUSE_BY_ADDR:
-            if addr not in self.device.FUSE_BY_ADDR:
+            if addr >= len(memory):
                 continue
             data = memory[addr]
             if data is None:
                 continue
-            fuse_name = self.updi.device.FUSE_BY_ADDR[addr]
-            print(
-                f"{fuse_name:<{max_len}}({addr:02X}): {data >> 4:04b} {data & 0x0F:04b} ({data:02X})")
+            if current[addr] == data:
+                logging.info(f"Fuse {addr:02X} not changed")
+                fuses.append((addr, data, False))
+                continue
+
             ph_addr = self.device.FUSES_base + addr
-            # updi.sts(device.NVMCTRL_ADDRL, addr) # writing word not write high byte
-            self.updi.sts(self.device.NVMCTRL_ADDRL, ph_addr & 0xFF)
-            self.updi.sts(self.device.NVMCTRL_ADDRH, ph_addr >> 8)
-            self.updi.sts(self.device.NVMCTRL_DATA, data & 0xFF)
+            self.wait_nvm_ready()
+            # DATAL, DATAH, ADDRL and ADDRH are continuous.
+            self.store(self.device.NVMCTRL_DATA,
+                       [data & 0xFF, 0x00, ph_addr & 0xFF, ph_addr >> 8])
             self.updi.sts(self.device.NVMCTRL_CTRLA,
                           self.device.NVMCTRL_CTRLA_CMD_WFU)
+            fuses.append((addr, data, True))
+            written += 1
 
-        self.reset()
+        if written > 0:
+            self.wait_nvm_ready()
+            self.reset()
+        return fuses
 
     def read_eeprom(self, addr=0x0000, size=None):
         return self.read_nvm(
@@ -147,12 +205,48 @@ class UPDI_FUNC:
             self.device.EEPROM_START_ADDR,
             addr, size)
 
-    def write_eeprom(self, memory):
-        self.write_nvm(
+    def iter_eeprom(self, addr=0x0000, size=None):
+        return self.iter_nvm(
             self.device.EEPROM_PAGE_SIZE,
             self.device.EEPROM_PAGE_COUNT,
             self.device.EEPROM_START_ADDR,
-            memory)
+            addr, size)
+
+    def write_eeprom(self, memory, pages=None):
+        return self.write_nvm(
+            self.device.EEPROM_PAGE_SIZE,
+            self.device.EEPROM_PAGE_COUNT,
+            self.device.EEPROM_START_ADDR,
+            memory, pages)
+
+    def verify_eeprom(self, crcs):
+        return self.verify_nvm(
+            self.device.EEPROM_PAGE_SIZE,
+            self.device.EEPROM_PAGE_COUNT,
+            self.device.EEPROM_START_ADDR,
+            crcs)
+
+    def read_userrow(self, addr=0x0000, size=None):
+        return self.read_nvm(
+            self.device.USERROW_SIZE,
+            1,
+            self.device.USERROW_base,
+            addr, size)
+
+    def write_userrow(self, memory, pages=None):
+        # user row is not erased by chip erase
+        return self.write_nvm(
+            self.device.USERROW_SIZE,
+            1,
+            self.device.USERROW_base,
+            memory, pages, erase=False)
+
+    def verify_userrow(self, crcs):
+        return self.verify_nvm(
+            self.device.USERROW_SIZE,
+            1,
+            self.device.USERROW_base,
+            crcs)
 
     def read_flash(self, addr=0x0000, size=None):
         return self.read_nvm(
@@ -161,25 +255,53 @@ class UPDI_FUNC:
             self.device.FLASH_START_ADDR,
             addr, size)
 
-    def write_flash(self, memory):
-        self.write_nvm(
+    def iter_flash(self, addr=0x0000, size=None):
+        return self.iter_nvm(
+            self.device.FLASH_PAGE_SIZE,
+            self.device.FLASH_PAGE_COUNT,
+            self.device.FLASH_START_ADDR,
+            addr, size)
+
+    def write_flash(self, memory, pages=None):
+        return self.write_nvm(
+            self.device.FLASH_PAGE_SIZE,
+            self.device.FLASH_PAGE_COUNT,
+            self.device.FLASH_START_ADDR,
+            memory, pages)
+
+    def verify_flash(self, crcs):
+        return self.verify_nvm(
             self.device.FLASH_PAGE_SIZE,
             self.device.FLASH_PAGE_COUNT,
             self.device.FLASH_START_ADDR,
-            memory)
+            crcs)
 
     def read_nvm(self, page_size, page_count, page_start, addr=0x0000, size=None):
-        self.unlock_nvm()
+        memory = bytearray(self.check_range(
+            page_size, page_count, addr, size))
+        for _ in self.iter_nvm(page_size, page_count, page_start, addr, size, memory):
+            pass
+        return memory
 
+    def check_range(self, page_size, page_count, addr=0x0000, size=None):
         nvm_size = page_size * page_count
         if not size:
             size = nvm_size - addr
         if not(0 < size <= nvm_size):
-            raise Exception(f"Read size Error: {size}")
+            raise UpdiError(f"Read size Error: {size}")
 
         last_addr = addr + size - 1
         if last_addr >= nvm_size:
-            raise Exception(f"Over segment Error: {last_addr}")
+            raise UpdiError(f"Over segment Error: {last_addr}")
+        return size
+
+    def iter_nvm(self, page_size, page_count, page_start, addr=0x0000, size=None, buffer=None):
+        # yield memoryview of each page as it is read into buffer
+        self.unlock_nvm()
+
+        size = self.check_range(page_size, page_count, addr, size)
+        if buffer is None:
+            buffer = bytearray(size)
 
         ph_addr = addr + page_start
         logging.info(f"Read from {addr:04X} ({ph_addr:04X})")
@@ -190,57 +312,180 @@ class UPDI_FUNC:
         logging.info(
             f"Read size: {size:04X} bytes ({pages:2X} pages + {remain_size:2X} bytes)")
 
-        memory = []
-        repeat_size = page_size - 1
-        logging.debug(f"repeat cout: {repeat_size}")
-        for page in range(pages):
-            self.updi.repeat(repeat_size)
-            memory += self.updi.ld(UPDI.AT_PTR_INC)
-            memory += self.updi.repeat_read(repeat_size)
-        if remain_size > 0:
-            repeat_size = remain_size - 1
-            logging.debug(f"repeat cout: {repeat_size}")
-            self.updi.repeat(repeat_size)
-            memory += self.updi.ld(UPDI.AT_PTR_INC)
-            memory += self.updi.repeat_read(repeat_size)
+        view = memoryview(buffer)
+        for offset in range(0, size, page_size):
+            chunk = view[offset:min(offset + page_size, size)]
+            self.load(chunk)
+            yield chunk
+
+    def verify_nvm(self, page_size, page_count, page_start, crcs):
+        # crcs: {page: crc32} of the expected pages
+        pages = sorted([page for page in crcs if page < page_count])
+        if len(pages) < len(crcs):
+            logging.error("Image is larger than the memory")
+            return False
+
+        # read each run of continuous pages at once
+        while pages:
+            first = pages[0]
+            count = 1
+            while count < len(pages) and pages[count] == first + count:
+                count += 1
+            memory = self.read_nvm(page_size, page_count, page_start,
+                                   first * page_size, count * page_size)
+            for i in range(count):
+                page_data = memory[i * page_size:(i + 1) * page_size]
+                if zlib.crc32(page_data) != crcs[first + i]:
+                    logging.error(
+                        f"Verify Error at {(first + i) * page_size:04X}")
+                    return False
+            pages = pages[count:]
 
-        return memory
+        return True
 
-    def write_nvm(self, page_size, page_count, page_start, memory):
-        self.chip_erase()
+    def write_nvm(self, page_size, page_count, page_start, memory, pages=None, erase=True):
+        # memory: list padded by None, or bytes-like padded by 0xFF.
+        # pages: list of non-empty pages already known.
+        # erase: chip erase before writing, or erase each page.
+        # return the number of written pages.
+        if erase:
+            self.chip_erase()
+            write_cmd = self.device.NVMCTRL_CTRLA_CMD_WP
+        else:
+            write_cmd = self.device.NVMCTRL_CTRLA_CMD_ERWP
 
         self.unlock_nvm()
 
-        col_size = shutil.get_terminal_size().columns
-        col_size = col_size - col_size % page_count - 10
-        for page in range(page_count):
+        written = 0
+        for page in (range(page_count) if pages is None else pages):
+            if page >= page_count:
+                logging.error(f"No page: {page}")
+                raise UpdiError("Over segment Error")
             prog_addr = page * page_size
             ph_addr = page_start + prog_addr
             raw_data = memory[prog_addr:prog_addr +
                               page_size]
-            if raw_data.count(None) == page_size:
-                # break
-                continue
+            if isinstance(memory, list):
+                if raw_data.count(None) == page_size:
+                    # break
+                    continue
+                data = bytes([0xFF if d is None else d for d in raw_data])
+            elif len(raw_data) == 0:
+                break
+            elif len(raw_data) < page_size:
+                data = bytes(raw_data).ljust(page_size, b"\xFF")
             else:
-                progress = (page + 1) / page_count
-                print(f"{int(progress * 100):>3}%", "[" + "#" * int(col_size * progress) + "." * (
-                    col_size - int(col_size * progress)) + "]", end="\r")
-                data = [0xFF if d is None else d for d in raw_data]
+                data = raw_data
+            if self.progress:
+                self.progress(page + 1, page_count)
             logging.info(f"Write address: {prog_addr:04X}, {ph_addr:04X}")
-            logging.debug(", ".join([f"{d:02X}" for d in data]))
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(bytes(data).hex(", ").upper())
+            # no ACK per byte paces the host, so wait for the last page
+            self.wait_nvm_ready()
             self.updi.st(UPDI.SET_PTR, ph_addr)
-            self.updi.repeat(page_size - 1)
-            self.updi.st(UPDI.AT_PTR_INC, data[0])
-            self.updi.repeat_write(data[1:])
+            self.updi.burst_write(data)
 
             self.updi.sts(self.device.NVMCTRL_ADDRL, ph_addr & 0xFF)
             self.updi.sts(self.device.NVMCTRL_ADDRH, ph_addr >> 8)
-            #self.updi.sts(self.device.NVMCTRL_CTRLA, self.device.NVMCTRL_CTRLA_CMD_ERWP)
-            self.updi.sts(self.device.NVMCTRL_CTRLA,
-                          self.device.NVMCTRL_CTRLA_CMD_WP)
+            self.updi.sts(self.device.NVMCTRL_CTRLA, write_cmd)
+            written += 1
 
-        print("100%", "[" + "#" * col_size + "]")
+        if self.progress:
+            self.progress(page_count, page_count)
+        self.wait_nvm_ready()
         self.reset()
+        return written
+
+
+def print_progress(done, total):
+    col_size = shutil.get_terminal_size().columns
+    col_size = col_size - col_size % total - 10
+    progress = done / total
+    print(f"{int(progress * 100):>3}%", "[" + "#" * int(col_size * progress) + "." * (
+        col_size - int(col_size * progress)) + "]", end="\r" if done < total else "\n")
+
+
+def print_fuses(device, fuses):
+    # fuses: iterable of (addr, data, ...)
+    max_len = max([len(k) for k in device.FUSES.keys()])
+    for addr, data, *_ in fuses:
+        if addr not in device.FUSE_BY_ADDR:
+            continue
+        fuse_name = device.FUSE_BY_ADDR[addr]
+        print(
+            f"{fuse_name:<{max_len}}({addr:02X}): {data >> 4:04b} {data & 0x0F:04b} ({data:02X})")
+
+
+def program_cached(updi, image, verify=False):
+    if image.has_addr(0x0):
+        if image.page_size(0x0) != updi.device.FLASH_PAGE_SIZE:
+            raise UpdiError("Image page size Error")
+        print("Programing Flash memory ...")
+        updi.write_flash(image.get_data(0x0), image.get_pages(0x0))
+        if verify:
+            if updi.verify_flash(image.get_crcs(0x0)):
+                print("Flash memory OK.")
+            else:
+                logging.error("Writing Flash memory Error")
+                raise VerifyError("Writing Flash memory Error")
+
+    if image.has_addr(0x81):
+        if image.page_size(0x81) != updi.device.EEPROM_PAGE_SIZE:
+            raise UpdiError("Image page size Error")
+        print("Writing EEPROM memory ...")
+        updi.write_eeprom(image.get_data(0x81), image.get_pages(0x81))
+        if verify:
+            if updi.verify_eeprom(image.get_crcs(0x81)):
+                print("EEPROM memory OK.")
+            else:
+                logging.error("Writing EEPROM memory Error")
+                raise VerifyError("Writing EEPROM memory Error")
+
+    if image.has_addr(0x83):
+        print("Writing user row ...")
+        updi.write_userrow(image.get_memory(0x83))
+
+    if image.has_addr(0x82):
+        print_fuses(updi.device, updi.write_fuses(image.get_memory(0x82)))
+
+
+def program_hex(updi, hex, verify=False):
+    if hex.has_addr(0x0):
+        print("Programing Flash memory ...")
+        bin = hex.get_memory(0x0)
+        updi.write_flash(bin)
+        read_size = 0x10000 - bin.count(None)
+        if verify and read_size:
+            read = updi.read_flash(size=read_size)
+            if bin[:read_size] == list(read):
+                print("Flash memory OK.")
+            else:
+                logging.error("Writing Flash memory Error")
+                raise VerifyError("Writing Flash memory Error")
+
+    if hex.has_addr(0x81):
+        print("Writing EEPROM memory ...")
+        bin = hex.get_memory(0x81)
+        updi.write_eeprom(bin)
+        read_size = 0x10000 - bin.count(None)
+        if verify and read_size:
+            read = updi.read_eeprom(size=read_size)
+            if bin[:read_size] == list(read):
+                print("EEPROM memory OK.")
+            else:
+                print(bin[:read_size])
+                print(list(read))
+                logging.error("Writing EEPROM memory Error")
+                raise VerifyError("Writing EEPROM memory Error")
+
+    if hex.has_addr(0x83):
+        print("Writing user row ...")
+        updi.write_userrow(hex.get_memory(0x83))
+
+    if hex.has_addr(0x82):
+        bin = hex.get_memory(0x82)
+        print_fuses(updi.device, updi.write_fuses(bin))
 
 
 def main():
@@ -254,12 +499,31 @@ def main():
     parser.add_argument("-ce", "--chip-erase",
                         help="Chip erase", action='store_true')
     parser.add_argument("-i", "--hex", help="hex file")
+    parser.add_argument("-c", "--cache", help="Cache parsed hex file",
+                        action='store_true')
+    parser.add_argument("--cache-dir", help="Cache directory")
     parser.add_argument("-v", "--verify",
                         help="Verify FLASH and EEPROM memory", action='store_true')
     parser.add_argument("-de", "--dump-eeprom", help="Dump EEPROM memory",
                         nargs='?', type=int, const=-1, default=0)
     parser.add_argument("-df", "--dump-flash", help="Dump FLASH memory",
                         nargs='?', type=int, const=-1, default=0)
+    parser.add_argument("-o", "--output", help="Dump output file")
+    parser.add_argument("--dump-format", help="Dump format",
+                        choices=["hex", "bin", "ihex"], default="hex")
+    parser.add_argument("-b", "--backup",
+                        help="Backup all memory to hex or img file")
+    parser.add_argument("--clone", help="Program the read image to next targets",
+                        action='store_true')
+    parser.add_argument("-m", "--monitor", help="Sample data memory ADDR[:SIZE] ...",
+                        action="extend", nargs="+", type=str)
+    parser.add_argument("--samples", help="Number of samples", type=int)
+    parser.add_argument("--interval", help="Sampling interval in seconds",
+                        type=float, default=0.0)
+    parser.add_argument("--monitor-format", help="Sample output format",
+                        choices=["csv", "bin"], default="csv")
+    parser.add_argument("--monitor-output", help="Sample output file")
+    parser.add_argument("--trace", help="Record link traffic to file")
     parser.add_argument("--debug", help="Set debug mode", action='store_true')
 
     args = parser.parse_args()
@@ -269,99 +533,143 @@ def main():
     else:
         logging.root.setLevel(logging.WARNING)
 
-    updi = UPDI_FUNC(args.line, device_name=args.device)
-
-    if args.hex:
-        hex = IHex()
-        hex.read_file(args.hex)
-
-        if hex.has_addr(0x0):
-            print("Programing Flash memory ...")
-            bin = hex.get_memory(0x0)
-            updi.write_flash(bin)
-            if args.verify:
-                read_size = 0x10000 - bin.count(None)
-                read = updi.read_flash(size=read_size)
-                if bin[:read_size] == read:
-                    print("Flash memory OK.")
-                else:
-                    logging.error("Writing Flash memory Error")
-                    raise Exception("Writing Flash memory Error")
-
-        if hex.has_addr(0x81):
-            print("Writing EEPROM memory ...")
-            bin = hex.get_memory(0x81)
-            updi.write_eeprom(bin)
-            if args.verify:
-                read_size = 0x10000 - bin.count(None)
-                read = updi.read_eeprom(size=read_size)
-                if bin[:read_size] == read:
-                    print("EEPROM memory OK.")
-                else:
-                    print(bin[:read_size])
-                    print(read)
-                    logging.error("Writing EEPROM memory Error")
-                    raise Exception("Writing EEPROM memory Error")
-
-        if hex.has_addr(0x82):
-            bin = hex.get_memory(0x82)
-            updi.write_fuses(bin)
-
-    if args.write_fuse:
-        for fuse in args.write_fuse:
-            kv = fuse.split(':')
-            if len(kv) == 2:
-                addr = int(kv[0], 16)
-                val = int(kv[1], 16)
-                updi.write_fuse(addr, val)
+    variables = []
+    for var in args.monitor or []:
+        kv = var.split(':')
+        try:
+            if len(kv) not in (1, 2):
+                raise ValueError(var)
+            size = int(kv[1]) if len(kv) == 2 else 1
+            if size < 1:
+                raise ValueError(var)
+            variables.append((int(kv[0], 16), size))
+        except ValueError:
+            logging.error(f"Format Error: {kv}")
+            raise UpdiError(f"Monitor format Error: {var}")
+
+    trace = TraceWriter(args.trace) if args.trace else None
+    # the trace of a failed run is the one needed
+    try:
+        updi = UPDI_FUNC(args.line, device_name=args.device, trace=trace,
+                         progress=print_progress)
+
+        if args.hex:
+            if args.hex.endswith(".img"):
+                image = CachedImage(args.hex)
+            elif args.cache:
+                image = ImageCache(args.cache_dir).load(args.hex, updi.device)
             else:
-                logging.error(f"Format Error: {kv}")
-
-    if args.read_fuse:
-        max_len = max([len(k) for k in updi.device.FUSES.keys()])
-        for addr, fuse in enumerate(updi.read_fuses()):
-            if addr not in updi.device.FUSE_BY_ADDR:
-                continue
-            fuse_name = updi.device.FUSE_BY_ADDR[addr]
-            print(
-                f"{fuse_name:<{max_len}}({addr:02X}): {fuse >> 4:04b} {fuse & 0x0F:04b} ({fuse:02X})")
+                image = None
 
-    if args.dump_eeprom:
-        if 0 < args.dump_eeprom <= updi.device.EEPROM_PAGE_COUNT:
-            page_count = args.dump_eeprom
-        else:
-            page_count = updi.device.EEPROM_PAGE_COUNT
-        read_size = page_count * updi.device.EEPROM_PAGE_SIZE
-        print(f"Reading {read_size} bytes of EEPROM memory")
-        memory = updi.read_eeprom(size=read_size)
-        for page in range(page_count):
-            print(" " * 5, " ".join([f"{x:2X}" for x in range(16)]))
-            for p in range(0, updi.device.EEPROM_PAGE_SIZE, 0x10):
-                block_start = page * updi.device.EEPROM_PAGE_SIZE + p
-                block = memory[block_start:block_start + 0x10]
-                print(f"{block_start:04X}:", " ".join(
-                    [f"{x:02X}" for x in block]))
-
-    if args.dump_flash:
-        if 0 < args.dump_flash <= updi.device.FLASH_PAGE_COUNT:
-            page_count = args.dump_flash
-        else:
-            page_count = updi.device.FLASH_PAGE_COUNT
-        read_size = page_count * updi.device.FLASH_PAGE_SIZE
-        print(f"Reading {read_size} bytes of FLASH memory")
-        memory = updi.read_flash(size=read_size)
-        for page in range(page_count):
-            print(" " * 5, " ".join([f"{x:2X}" for x in range(16)]))
-            for p in range(0, updi.device.FLASH_PAGE_SIZE, 0x10):
-                block_start = page * updi.device.FLASH_PAGE_SIZE + p
-                block = memory[block_start:block_start + 0x10]
-                print(f"{block_start:04X}:", " ".join(
-                    [f"{x:02X}" for x in block]))
-
-    if args.chip_erase:
-        updi.chip_erase(force=True)
-
-    updi.close()
+            if image:
+                with image:
+                    program_cached(updi, image, args.verify)
+            else:
+                hex = IHex()
+                hex.read_file(args.hex)
+                program_hex(updi, hex, args.verify)
+
+        if args.write_fuse:
+            fuses = [None for _ in range(max(updi.device.FUSE_BY_ADDR) + 1)]
+            for fuse in args.write_fuse:
+                kv = fuse.split(':')
+                if len(kv) == 2:
+                    addr = int(kv[0], 16)
+                    val = int(kv[1], 16)
+                    if addr not in updi.device.FUSE_BY_ADDR:
+                        logging.error(f"No fuse at {addr:02X}")
+                        raise UpdiError("Fuse address Error")
+                    fuses[addr] = val
+                else:
+                    logging.error(f"Format Error: {kv}")
+            print_fuses(updi.device, updi.write_fuses(fuses))
+
+        if args.read_fuse:
+            print_fuses(updi.device, enumerate(updi.read_fuses()))
+
+        if args.dump_eeprom or args.dump_flash:
+            dump = open_dump(args.dump_format, args.output)
+            # keep binary output on stdout clean
+            msg_out = sys.stdout if args.output or args.dump_format == "hex" else sys.stderr
+
+            try:
+                if args.dump_eeprom:
+                    if 0 < args.dump_eeprom <= updi.device.EEPROM_PAGE_COUNT:
+                        page_count = args.dump_eeprom
+                    else:
+                        page_count = updi.device.EEPROM_PAGE_COUNT
+                    read_size = page_count * updi.device.EEPROM_PAGE_SIZE
+                    print(f"Reading {read_size} bytes of EEPROM memory", file=msg_out)
+                    dump.segment(0x81)
+                    for chunk in updi.iter_eeprom(size=read_size):
+                        dump.write(chunk)
+
+                if args.dump_flash:
+                    if 0 < args.dump_flash <= updi.device.FLASH_PAGE_COUNT:
+                        page_count = args.dump_flash
+                    else:
+                        page_count = updi.device.FLASH_PAGE_COUNT
+                    read_size = page_count * updi.device.FLASH_PAGE_SIZE
+                    print(f"Reading {read_size} bytes of FLASH memory", file=msg_out)
+                    dump.segment(0x00)
+                    for chunk in updi.iter_flash(size=read_size):
+                        dump.write(chunk)
+
+                dump.close()
+            finally:
+                if args.output:
+                    dump.out.close()
+
+        if args.backup or args.clone:
+            print("Reading all memory ...")
+            image = read_image(updi)
+            if args.backup:
+                write_image(image, args.backup, updi.device)
+                print(f"Saved to {args.backup}")
+
+        if args.chip_erase:
+            updi.chip_erase(force=True)
+
+        if args.monitor:
+            updi.resume()
+            sampler = Sampler(updi, variables)
+            count, rate = sampler.run(open_samples(args.monitor_format, args.monitor_output),
+                                      args.samples, args.interval)
+            print(f"{count} samples, {rate:.1f} samples/s", file=sys.stderr)
+
+        updi.close()
+
+        if args.clone:
+            count = 0
+            while True:
+                try:
+                    input("Connect next target and press Enter (Ctrl-D to quit): ")
+                except EOFError:
+                    print()
+                    break
+                # open the link apart from the target to close it on any error
+                link = UPDI(args.line, trace=trace, connect=False)
+                try:
+                    link.open()
+                    target = UPDI_FUNC(
+                        None, device_name=updi.device.DEVICE_NAME, updi=link,
+                        progress=print_progress)
+                    program_hex(target, image, verify=True)
+                    count += 1
+                    print(f"Cloned: {count}")
+                except Exception as e:
+                    logging.error(f"Clone Error: {e}")
+                    print(f"Failed: {e}")
+                finally:
+                    try:
+                        link.req_reset()
+                        link.disable()
+                    except Exception:
+                        pass
+                    link.close_link()
+    finally:
+        if trace:
+            trace.close()
 
 
 if __name__ == '__main__':